@@ -1,2 +1,5 @@
 from plottercon import main
-main()
\ No newline at end of file
+
+# worker processes (focus stacking) re-import this file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -1,2 +1,2 @@
-from plottercon import main
-main()
\ No newline at end of file
+from plottercon.cli import main
+main()
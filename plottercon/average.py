@@ -0,0 +1,114 @@
+import time
+import cv2
+import numpy as np
+
+METHODS = ['mean', 'median']
+
+
+def median_frames(stack, out, tmp):
+    # odd-even transposition sort down the first axis with elementwise
+    # min / max, an order of magnitude quicker than np.median for a handful
+    # of uint8 frames. Sorts stack in place.
+    n = len(stack)
+    for r in range(n):
+        for i in range(r % 2, n - 1, 2):
+            np.minimum(stack[i], stack[i + 1], out=tmp)
+            np.maximum(stack[i], stack[i + 1], out=stack[i + 1])
+            np.copyto(stack[i], tmp)
+    if n % 2:
+        np.copyto(out, stack[n // 2])
+    else:
+        cv2.addWeighted(stack[n // 2 - 1], 0.5, stack[n // 2], 0.5, 0, dst=out)
+    return out
+
+
+class FrameAverager(object):
+    # Combines consecutive frames of one tile to cut sensor noise. Mean
+    # frames go into a float32 accumulator, median ones into a preallocated
+    # stack. Each frame's small grey copy is checked against the running
+    # mean of the ones taken so far: a moving frame restarts the run while
+    # it is short (the stage was still settling) and is dropped once the
+    # run is established (a knock mid-capture).
+    def __init__(self, frames=4, method='mean', thresh=2.0):
+        self.frames = max(1, int(frames))
+        self.method = method if method in METHODS else 'mean'
+        self.thresh = thresh
+        self.acc = None
+        self.stack = None
+        self.tmp = None
+        self.small_acc = None
+        self.out = None
+        self.count = 0
+        self.rejected = 0
+        self.run_start = None
+
+    def reset(self):
+        self.count = 0
+        self.rejected = 0
+        self.run_start = None
+
+    def alloc(self, shape, small_shape):
+        if self.method == 'mean':
+            self.acc = np.empty(shape, np.float32)
+        else:
+            self.stack = np.empty((self.frames,) + shape, np.uint8)
+            self.tmp = np.empty(shape, np.uint8)
+        self.small_acc = np.empty(small_shape, np.float32)
+        self.out = np.empty(shape, np.uint8)
+
+    def motion(self, small):
+        # mean absolute difference from the running mean, in grey levels
+        mean = self.small_acc * (1.0 / self.count)
+        return float(np.abs(small - mean).mean())
+
+    def add(self, raw, small):
+        # returns True once enough frames are in
+        if self.out is None or self.out.shape != raw.shape:
+            self.alloc(raw.shape, small.shape)
+            self.count = 0
+        if self.count and self.motion(small) > self.thresh:
+            self.rejected += 1
+            if self.count > 1 and self.rejected <= self.count:
+                return False
+            self.count = 0 # still moving, or the view really changed
+        if self.count == 0:
+            self.run_start = time.time()
+            self.rejected = 0
+            self.small_acc[:] = small
+            if self.acc is not None:
+                self.acc[:] = raw
+        else:
+            cv2.accumulate(small, self.small_acc)
+            if self.acc is not None:
+                cv2.accumulate(raw, self.acc)
+        if self.stack is not None:
+            self.stack[self.count] = raw
+        self.count += 1
+        return self.count >= self.frames
+
+    def result(self):
+        if not self.count:
+            return None
+        if self.acc is not None:
+            return cv2.convertScaleAbs(self.acc, self.out, 1.0 / self.count)
+        return median_frames(self.stack[:self.count], self.out, self.tmp)
+
+
+def average_frames(grabber, averager, start=0, timeout=5.0, stopped=None):
+    # feed fresh frames from start (a time.time()) into the averager until
+    # it has enough or timeout runs out, returns the combined frame
+    averager.reset()
+    wait = start - time.time()
+    if wait > 0:
+        time.sleep(wait)
+    end = time.time() + timeout
+    seq = grabber.frame_seq()
+    while True:
+        remain = end - time.time()
+        if remain <= 0 or (stopped and stopped()): break
+        res = grabber.wait_frame(seq, min(remain, 1.0))
+        if res is None: continue
+        seq, raw, small = res
+        # accumulate at once, the grabber reuses its buffers
+        if averager.add(raw, small): break
+    return averager.result()
@@ -0,0 +1,138 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# name: (xsteps, ysteps, z_levels, z_step)
+CASES = {
+    'small': (5, 5, 1, 0.0),
+    '50x50': (50, 50, 1, 0.0),
+    'multiz': (10, 10, 3, 0.1),
+    'stream': (10, 10, 1, 0.0),
+}
+# scan options a case always runs with, streamed markers while the
+# status is polled hard, every tile must still be taken at rest
+CASE_ARGS = {
+    'stream': ['--stream', '--firmware', 'grbl', '--char-count', '--status-poll', '0.02',
+               '--settle-max', '0.2'],
+}
+# what cpu_pct and peak_rss_mb measure. The simulated camera renders from
+# the simulated machine's state, so both run inside the scan process.
+RESOURCE_SCOPE = 'scan process including the simulator (machine, controller server, camera)'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def git_version():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_case(name, scan_args, keep=False):
+    # one scan per subprocess so CPU time and peak RSS belong to that case
+    xsteps, ysteps, z_levels, z_step = CASES[name]
+    out_dir = tempfile.mkdtemp(prefix=f'plottercon-bench-{name}-')
+    cmd = [sys.executable, '-m', 'plottercon', 'scan', '--sim', '--no-config',
+           '--xsteps', str(xsteps), '--ysteps', str(ysteps),
+           '--zlevels', str(z_levels), '--zstep', str(z_step),
+           '--out', out_dir] + CASE_ARGS.get(name, []) + list(scan_args)
+    pkg_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [pkg_root, env.get('PYTHONPATH')]))
+
+    events = []
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env)
+    for line in proc.stdout:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    proc.wait()
+    wall = time.time() - start
+    if not keep:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return summarize(name, events, wall, proc.returncode)
+
+def summarize(name, events, wall, returncode):
+    # per-tile latency is the gap between consecutive progress reports
+    progress = [(e['tile'], e['time']) for e in events if e['event'] == 'progress']
+    latencies = []
+    for (a, ta), (b, tb) in zip(progress, progress[1:]):
+        if b == a + 1:
+            latencies.append(tb - ta)
+    complete = next((e for e in events if e['event'] == 'complete'), None)
+    stats = next((e for e in events if e['event'] == 'stats'), {})
+    errors = [e['message'] for e in events if e['event'] == 'error']
+
+    tiles = progress[-1][0] if progress else 0
+    scan_time = (complete['time'] - progress[0][1]) if complete and progress else None
+    cpu = stats.get('cpu_time')
+    res = {
+        'case': name,
+        'grid': list(CASES[name]),
+        'ok': returncode == 0 and bool(complete and complete['complete']),
+        'tiles': tiles,
+        'wall_s': round(wall, 3),
+        'scan_s': round(scan_time, 3) if scan_time else None,
+        'tiles_per_min': round(tiles * 60.0 / scan_time, 2) if scan_time else None,
+        'tile_p50_s': round(percentile(latencies, 50), 4) if latencies else None,
+        'tile_p99_s': round(percentile(latencies, 99), 4) if latencies else None,
+        'cpu_s': cpu,
+        'cpu_pct': round(100.0 * cpu / scan_time, 1) if cpu and scan_time else None,
+        'peak_rss_mb': stats.get('peak_rss_mb'),
+        'writer': stats.get('writer'),
+        'rx_overflows': stats.get('rx_overflows'),
+        'moving_captures': stats.get('moving_captures'),
+        'errors': errors,
+    }
+    return res
+
+def compare(results, baseline):
+    # lines comparing against an earlier results file, + means better
+    scope = results.get('resource_scope')
+    lines = [f'cpu_pct and peak_rss_mb are for the {scope}']
+    if baseline.get('resource_scope') != scope:
+        lines.append(f'baseline measured {baseline.get("resource_scope") or "an unrecorded scope"}, '
+                     'cpu_pct and peak_rss_mb may not compare')
+    old = {c['case']: c for c in baseline.get('cases', [])}
+    for case in results['cases']:
+        prev = old.get(case['case'])
+        if not prev: continue
+        for key, higher_better in (('tiles_per_min', True), ('tile_p50_s', False),
+                                   ('tile_p99_s', False), ('cpu_pct', False), ('peak_rss_mb', False)):
+            a, b = prev.get(key), case.get(key)
+            if not a or b is None: continue
+            change = 100.0 * (b - a) / a
+            if not higher_better: change = -change
+            lines.append(f'{case["case"]:>8} {key:<14} {a:>10} -> {b:<10} {change:+.1f}%')
+    return lines
+
+def run_bench(cases, scan_args, keep=False):
+    results = {
+        'version': git_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scan_args': list(scan_args),
+        'resource_scope': RESOURCE_SCOPE,
+        'cases': [],
+    }
+    for name in cases:
+        results['cases'].append(run_case(name, scan_args, keep))
+    return results
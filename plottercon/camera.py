@@ -1,191 +1,77 @@
 import wx
 from io import BytesIO
 import urllib.request
-from pubsub import pub
-import time
-import errno
-from threading import Thread, Lock
+from threading import Lock
 import cv2
-import os
 import numpy as np
-from . import events
 from . control import Control
-from . import events
-
-class CamUpdateThread(Thread):
-    def __init__(self, panel):
-        super().__init__()
+from . settle import SettleTracker
+from . writer import ImageWriter
+from . journal import load_journal
+from . grabber import FrameGrabber, PreviewThread, open_camera, camera_size, camera_modes, square_crop
+from . scan import ScanRunner
+from . timing import PHASES, fmt_secs
+from . estimate import ScanEstimate, DEFAULT_ACCEL
+from . planner import ORDERS
+
+class CamUpdateThread(FrameGrabber):
+    def __init__(self, panel, preview_fps=10.0, calib=None, modes=None):
         self.panel = panel
-        self.raw_frame = None
         self.frame = None
         self.bmp = None
-        self.stop = False
-        self.lock = Lock()
-        self.start()
-
-    def capture(self):
-        if self.panel.camera is None:
-            return False
-
-        with self.lock:
-            result, self.raw_frame = self.panel.camera.read()
-
-            if result:
-                self.raw_frame = cv2.rotate(self.raw_frame, cv2.ROTATE_180)
-                y = self.panel.crop_y
-                h = self.panel.crop_height
-                x = self.panel.crop_x
-                w = self.panel.crop_width
-                self.raw_frame = self.raw_frame[y:y+h, x:x+h]
-                self.frame = cv2.cvtColor(self.raw_frame, cv2.COLOR_BGR2RGB)
-                if self.panel.disp_width > 0 and self.panel.disp_height > 0:
-                    self.frame = cv2.resize(self.frame, (self.panel.disp_width, self.panel.disp_height))
-
-                h, w = self.frame.shape[:2]
-                self.bmp = wx.Bitmap.FromBuffer(w, h, self.frame)
-
-        return result
+        self.bmp_lock = Lock()
+        self.disp = None
+        crop = (panel.crop_x, panel.crop_y, panel.crop_width, panel.crop_height)
+        if modes:
+            crop = square_crop # per mode frame size
+        super().__init__(panel.camera, crop, calib=calib, modes=modes)
+        self.preview = PreviewThread(self, self.render, preview_fps)
+
+    def render(self, raw):
+        # preview thread, the grab loop carries on meanwhile
+        if wx.GetApp() is None:
+            return False # app is closing, just quit
+
+        w, h = self.panel.disp_width, self.panel.disp_height
+        if w <= 0 or h <= 0:
+            h, w = raw.shape[:2]
+        # display sized buffers, reused until the panel is resized
+        if self.disp is None or self.disp[0].shape[:2] != (h, w):
+            self.disp = (np.empty((h, w, 3), np.uint8), np.empty((h, w, 3), np.uint8))
+        scaled, rgb = self.disp
+        if (h, w) != raw.shape[:2]:
+            raw = cv2.resize(raw, (w, h), dst=scaled, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(raw, cv2.COLOR_BGR2RGB, dst=rgb)
+        bmp = wx.Bitmap.FromBuffer(w, h, rgb) # copies
+        with self.bmp_lock:
+            self.frame = rgb
+            self.bmp = bmp
+
+        wx.CallAfter(self.panel.update)
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        self.preview.join(timeout)
 
     def get_frame(self):
-        with self.lock:
+        with self.bmp_lock:
             return self.frame
 
-    def get_raw_frame(self):
-        with self.lock:
-            return self.raw_frame
-
     def get_bmp(self):
-        with self.lock:
+        with self.bmp_lock:
             return self.bmp
 
-    def run(self):
-        print('Start cam thread')
-        while not self.stop:
-            if self.capture():
-                if wx.GetApp() is None:
-                    break # app is closing, just quit
-                wx.CallAfter(self.panel.update)
-            time.sleep(1.0/10)
-        print('End cam thread')
-
-class CamRunThread(Thread):
+class CamRunThread(ScanRunner):
     def __init__(self, cam_ui, control):
-        super().__init__()
         self.cam_ui = cam_ui
-        self.control = control
-        self.stop = False
-        self.pause = False
-        self.running_cap = False
-        self.stop_cap = False
-        self.stop_cmd = False
-
-        self.xsteps = 0
-        self.ysteps = 0
-        self.inc = 0
-        self.z_levels = 0
-        self.z_step = 0
-        self.out_dir = None
-
-        self.cmd = None
-
-        self.start()
-
-    def cmd_frame(self):
-        self.cmd = None
-        speed = self.control.jog_speed
-        dwell_time = 1.5
-        dwell = f'G4 S{dwell_time}'
-        cmds = [
-            self.control.gcode_rel_header(),
-            self.control.move_cmd(x=self.xsteps*self.inc, speed=speed),
-            dwell,
-            self.control.move_cmd(y=self.ysteps*self.inc, speed=speed),
-            dwell,
-            self.control.move_cmd(x=self.xsteps*self.inc*-1, speed=speed),
-            dwell,
-            self.control.move_cmd(y=self.ysteps*self.inc*-1, speed=speed),
-            'G90',
-        ]
-        self.control.Send(cmds)
-
-    def do_frame(self, x, y, inc):
-        self.xsteps = x
-        self.ysteps = y
-        self.inc = inc
-        self.cmd = self.cmd_frame
-
-    def cmd_run_capture(self):
-        self.cmd = None
-        self.pause = False
-        self.stop_cap = False
-        self.running_cap = True
-        _x, _y, _z = self.control.Position()[:3]
-        speed = self.control.jog_speed
-        count = 0
-        wx.CallAfter(self.cam_ui.UpdateProgress, count)
-
-        self.control.Send(self.control.gcode_abs_header())
-        z_range = [_z + (i*self.z_step) for i in range(self.z_levels)]
-        for z in z_range:
-            subdir = f'Z{z}'
-            out_dir = os.path.join(self.out_dir, subdir)
-            try:
-                os.makedirs(out_dir)
-            except OSError as ex:
-                if ex.errno == errno.EEXIST and os.path.isdir(out_dir):
-                    pass
-
-            move = self.control.move_cmd(z=z, speed=self.control.jog_z_speed)
-            self.control.Send(move)
-            while True:
-                if self.control.Position()[2] == z: break
-                time.sleep(0.5)
-
-            y_range = [_y + (i*self.inc) for i in range(self.ysteps + 1)]
-            x_range = [_x + (i*self.inc) for i in range(self.xsteps + 1)]
-            x_range.reverse() #reverse initially so we can just call rev every time
-            for y in y_range:
-                x_range.reverse()
-                for x in x_range:
-                    count += 1
-                    wx.CallAfter(self.cam_ui.UpdateProgress, count)
-                    if self.stop or self.stop_cap: return
-                    elif self.pause:
-                        while self.pause:
-                            time.sleep(0.1)
-                    move = self.control.move_cmd(x=x, y=y, speed=speed)
-                    self.control.Send(move)
-                    while True and not self.stop_cap:
-                        pos = self.control.Position()
-                        if pos[0] == x and pos[1] == y: break
-                        time.sleep(0.25)
-                    name = f'Z{z}Y{y}X{x}'
-                    time.sleep(1) # hold to settle motion
-                    self.cam_ui.take_picture(out_dir, name)
-                
-            complete = (not self.stop)
-
-        self.control.Send(self.control.move_cmd(x=_x, y=_y, speed=speed))
-        self.control.Send(self.control.move_cmd(z=_z, speed=self.control.jog_z_speed))
-        self.running_cap = False
-        wx.CallAfter(self.cam_ui.CaptureComplete, complete)
-
-
-    def do_run_capture(self, xsteps, ysteps, inc, z_levels, z_step, out_dir):
-        self.xsteps = xsteps
-        self.ysteps = ysteps
-        self.inc = inc
-        self.z_levels = z_levels
-        self.z_step = z_step
-        self.out_dir = out_dir
-        self.cmd = self.cmd_run_capture
-
-    def run(self):
-        while not self.stop:
-            if self.cmd:
-                self.cmd()
-            else:
-                time.sleep(0.05)
+        cameras = {cam_id: grabber for cam_id, (_, grabber) in cam_ui.extra_cameras.items()}
+        super().__init__(control, cam_ui.cam_thread, cam_ui.writer, cam_ui, cameras)
+
+    def notify(self, name, *args):
+        if wx.GetApp() is None: return
+        cb = getattr(self.cam_ui, name, None)
+        if cb is not None:
+            wx.CallAfter(cb, *args)
 
 class videoPanel(wx.Panel):
     def __init__(self, parent):
@@ -217,6 +103,237 @@ class videoPanel(wx.Panel):
         self.x = x
         self.y = y
 
+class MosaicPanel(wx.Panel):
+    # Shows the scan's MosaicCanvas scaled to fit, only repainting the
+    # parts of the panel covering tiles placed since the last update.
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.canvas = None
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_SIZE, self.OnSize)
+
+    def SetCanvas(self, canvas):
+        self.canvas = canvas
+        self.Refresh()
+
+    def Scale(self):
+        w, h = self.GetClientSize()
+        rows, cols = self.canvas.shape[:2]
+        return min(w / cols, h / rows)
+
+    def UpdateTiles(self):
+        if self.canvas is None or not self.IsShownOnScreen():
+            return
+        scale = self.Scale()
+        for x, y, w, h in self.canvas.take_dirty():
+            self.RefreshRect(wx.Rect(int(x*scale), int(y*scale), int(w*scale)+2, int(h*scale)+2), False)
+
+    def OnSize(self, e):
+        self.Refresh()
+        e.Skip()
+
+    def OnPaint(self, e):
+        dc = wx.PaintDC(self)
+        dc.SetBrush(wx.Brush(wx.BLACK))
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        it = wx.RegionIterator(self.GetUpdateRegion())
+        while it.HaveRects():
+            rect = it.GetRect()
+            dc.DrawRectangle(rect)
+            if self.canvas is not None:
+                self.PaintRect(dc, rect)
+            it.Next()
+
+    def PaintRect(self, dc, rect):
+        # map the panel rect back onto the canvas and draw just that part
+        scale = self.Scale()
+        if scale <= 0: return
+        rows, cols = self.canvas.shape[:2]
+        x0 = min(cols, int(rect.x / scale))
+        y0 = min(rows, int(rect.y / scale))
+        x1 = min(cols, int(np.ceil((rect.x + rect.width) / scale)))
+        y1 = min(rows, int(np.ceil((rect.y + rect.height) / scale)))
+        dx, dy = int(x0 * scale), int(y0 * scale)
+        dw, dh = int(x1 * scale) - dx, int(y1 * scale) - dy
+        if dw <= 0 or dh <= 0: return
+        part = self.canvas.view(x0, y0, x1 - x0, y1 - y0)
+        part = cv2.resize(part, (dw, dh), interpolation=cv2.INTER_AREA)
+        part = cv2.cvtColor(part, cv2.COLOR_BGR2RGB)
+        dc.DrawBitmap(wx.Bitmap.FromBuffer(dw, dh, part), dx, dy)
+
+class ScanOptions(wx.Panel):
+    SETTLE_MODES = ['fixed', 'adaptive']
+    ORDER_LABELS = ['Z-major', 'XY-major']
+    TILE_FORMATS = ['jpeg', 'png', 'raw']
+    AVERAGE_METHODS = ['mean', 'median']
+    FOCUS_MAPS = ['off', 'plane', 'bilinear', 'tps']
+
+    def __init__(self, parent, cfg):
+        super().__init__(parent)
+        self.cfg = cfg
+        self.InitUI()
+
+    def SaveConfig(self):
+        for key, val in self.GetOptions().items():
+            self.cfg[f'cam_{key}'] = val
+
+    def GetOptions(self):
+        return {
+            'settle_mode': self.SETTLE_MODES[self.chSettleMode.GetSelection()],
+            'settle_max': self.sbSettleMax.GetValue(),
+            'settle_thresh': self.sbSettleThresh.GetValue(),
+            'stream': self.cbStream.GetValue(),
+            'stream_hold': self.sbStreamHold.GetValue(),
+            'stream_lookahead': self.sbStreamLookahead.GetValue(),
+            'accel': self.sbAccel.GetValue(),
+            'mosaic_tile': self.sbMosaicTile.GetValue(),
+            'stack': self.cbStack.GetValue(),
+            'order': ORDERS[self.chOrder.GetSelection()],
+            'preview_fps': self.sbPreviewFps.GetValue(),
+            'preview_width': self.sbPreviewWidth.GetValue(),
+            'extra_cameras': self.ExtraCameras(),
+            'container': self.cbContainer.GetValue(),
+            'tile_format': self.TILE_FORMATS[self.chTileFormat.GetSelection()],
+            'jpeg_quality': self.sbJpegQuality.GetValue(),
+            'png_level': self.sbPngLevel.GetValue(),
+            'average': self.sbAverage.GetValue(),
+            'average_method': self.AVERAGE_METHODS[self.chAverageMethod.GetSelection()],
+            'average_thresh': self.sbAverageThresh.GetValue(),
+            'autofocus': self.cbAutofocus.GetValue(),
+            'af_range': self.sbAfRange.GetValue(),
+            'af_steps': self.sbAfSteps.GetValue(),
+            'af_tol': self.sbAfTol.GetValue(),
+            'focus_map': self.FOCUS_MAPS[self.chFocusMap.GetSelection()],
+            'focus_points': self.sbFocusPoints.GetValue(),
+        }
+
+    def ExtraCameras(self):
+        ids = []
+        for part in self.txtExtraCameras.GetValue().replace(',', ' ').split():
+            try:
+                ids.append(int(part))
+            except ValueError:
+                pass
+        return ids
+
+    def AddRow(self, label, ctrl):
+        row = self.row
+        self.gs.Add(wx.StaticText(self, label=label), (row, 0), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.gs.Add(ctrl, (row, 1))
+        self.row += 1
+        return ctrl
+
+    def InitUI(self):
+        vbox = wx.BoxSizer(wx.VERTICAL)
+        self.gs = wx.GridBagSizer(5, 5)
+        self.row = 0
+
+        self.chSettleMode = wx.Choice(self, choices=['Fixed Delay', 'Adaptive (camera motion)'])
+        mode = self.cfg.get('cam_settle_mode', 'fixed')
+        self.chSettleMode.SetSelection(self.SETTLE_MODES.index(mode) if mode in self.SETTLE_MODES else 0)
+        self.AddRow('Settle Mode', self.chSettleMode)
+
+        self.sbSettleMax = wx.SpinCtrlDouble(self, min=0, max=10, initial=self.cfg.get('cam_settle_max', 1.0), inc=0.1)
+        self.sbSettleMax.SetDigits(2)
+        self.AddRow('Settle Time / Max (s)', self.sbSettleMax)
+
+        self.sbSettleThresh = wx.SpinCtrlDouble(self, min=0.1, max=50, initial=self.cfg.get('cam_settle_thresh', 1.5), inc=0.1)
+        self.sbSettleThresh.SetDigits(1)
+        self.AddRow('Settle Motion Threshold', self.sbSettleThresh)
+
+        self.chOrder = wx.Choice(self, choices=['Z-major (each level in turn)', 'XY-major (all levels at each tile)'])
+        order = self.cfg.get('cam_order', 'z_major')
+        self.chOrder.SetSelection(ORDERS.index(order) if order in ORDERS else 0)
+        self.AddRow('Capture Order', self.chOrder)
+
+        self.cbStream = wx.CheckBox(self, label='Stream moves to controller')
+        self.cbStream.SetValue(self.cfg.get('cam_stream', False))
+        self.AddRow('Motion', self.cbStream)
+
+        self.sbStreamHold = wx.SpinCtrlDouble(self, min=0.05, max=5, initial=self.cfg.get('cam_stream_hold', 0.25), inc=0.05)
+        self.sbStreamHold.SetDigits(2)
+        self.AddRow('Capture Hold (s)', self.sbStreamHold)
+
+        self.sbStreamLookahead = wx.SpinCtrl(self, min=1, max=16, initial=self.cfg.get('cam_stream_lookahead', 2))
+        self.AddRow('Tiles Queued Ahead', self.sbStreamLookahead)
+
+        self.sbAccel = wx.SpinCtrlDouble(self, min=1, max=100000, initial=self.cfg.get('cam_accel', DEFAULT_ACCEL), inc=50)
+        self.sbAccel.SetDigits(0)
+        self.AddRow('Acceleration (mm/s²)', self.sbAccel)
+
+        self.sbMosaicTile = wx.SpinCtrl(self, min=0, max=512, initial=self.cfg.get('cam_mosaic_tile', 64))
+        self.AddRow('Mosaic Tile Size (px, 0 off)', self.sbMosaicTile)
+
+        self.sbAverage = wx.SpinCtrl(self, min=1, max=32, initial=self.cfg.get('cam_average', 1))
+        self.AddRow('Frames Averaged Per Tile', self.sbAverage)
+
+        self.chAverageMethod = wx.Choice(self, choices=['Mean', 'Median'])
+        method = self.cfg.get('cam_average_method', 'mean')
+        self.chAverageMethod.SetSelection(self.AVERAGE_METHODS.index(method) if method in self.AVERAGE_METHODS else 0)
+        self.AddRow('Average Method', self.chAverageMethod)
+
+        self.sbAverageThresh = wx.SpinCtrlDouble(self, min=0.1, max=50, initial=self.cfg.get('cam_average_thresh', 2.0), inc=0.1)
+        self.sbAverageThresh.SetDigits(1)
+        self.AddRow('Average Motion Threshold', self.sbAverageThresh)
+
+        self.cbAutofocus = wx.CheckBox(self, label='Autofocus every tile (levels centre on focus)')
+        self.cbAutofocus.SetValue(self.cfg.get('cam_autofocus', False))
+        self.AddRow('Focus', self.cbAutofocus)
+
+        self.sbAfRange = wx.SpinCtrlDouble(self, min=0.01, max=20, initial=self.cfg.get('cam_af_range', 1.0), inc=0.1)
+        self.sbAfRange.SetDigits(2)
+        self.AddRow('Autofocus Range (mm)', self.sbAfRange)
+
+        self.sbAfSteps = wx.SpinCtrl(self, min=3, max=50, initial=self.cfg.get('cam_af_steps', 7))
+        self.AddRow('Autofocus Coarse Steps', self.sbAfSteps)
+
+        self.sbAfTol = wx.SpinCtrlDouble(self, min=0.001, max=1, initial=self.cfg.get('cam_af_tol', 0.01), inc=0.001)
+        self.sbAfTol.SetDigits(3)
+        self.AddRow('Autofocus Tolerance (mm)', self.sbAfTol)
+
+        self.chFocusMap = wx.Choice(self, choices=['Off', 'Plane', 'Bilinear grid', 'Thin-plate spline'])
+        fmap = self.cfg.get('cam_focus_map', 'off')
+        self.chFocusMap.SetSelection(self.FOCUS_MAPS.index(fmap) if fmap in self.FOCUS_MAPS else 0)
+        self.AddRow('Focus Map Pre-scan', self.chFocusMap)
+
+        self.sbFocusPoints = wx.SpinCtrl(self, min=2, max=10, initial=self.cfg.get('cam_focus_points', 3))
+        self.AddRow('Focus Map Points Per Axis', self.sbFocusPoints)
+
+        self.sbPreviewFps = wx.SpinCtrlDouble(self, min=0, max=60, initial=self.cfg.get('cam_preview_fps', 10.0), inc=1)
+        self.sbPreviewFps.SetDigits(0)
+        self.AddRow('Preview FPS (0 off)', self.sbPreviewFps)
+
+        self.sbPreviewWidth = wx.SpinCtrl(self, min=0, max=4096, initial=self.cfg.get('cam_preview_width', 640))
+        self.AddRow('Preview Width (px, 0 full)', self.sbPreviewWidth)
+
+        extra = ', '.join(str(i) for i in self.cfg.get('cam_extra_cameras', []))
+        self.txtExtraCameras = wx.TextCtrl(self, value=extra)
+        self.txtExtraCameras.SetToolTip('Camera ids also captured at every tile, saved under cam<id>/')
+        self.AddRow('Extra Cameras', self.txtExtraCameras)
+
+        self.cbContainer = wx.CheckBox(self, label='Chunked container (tiles.idx + tiles.NNN.dat)')
+        self.cbContainer.SetValue(self.cfg.get('cam_container', False))
+        self.AddRow('Tile Storage', self.cbContainer)
+
+        self.chTileFormat = wx.Choice(self, choices=['JPEG', 'PNG (lossless)', 'Raw (lossless)'])
+        fmt = self.cfg.get('cam_tile_format', 'jpeg')
+        self.chTileFormat.SetSelection(self.TILE_FORMATS.index(fmt) if fmt in self.TILE_FORMATS else 0)
+        self.AddRow('Container Tile Format', self.chTileFormat)
+
+        self.sbJpegQuality = wx.SpinCtrl(self, min=1, max=100, initial=self.cfg.get('cam_jpeg_quality', 95))
+        self.AddRow('Container JPEG Quality', self.sbJpegQuality)
+
+        self.sbPngLevel = wx.SpinCtrl(self, min=0, max=9, initial=self.cfg.get('cam_png_level', 1))
+        self.AddRow('Container PNG Level', self.sbPngLevel)
+
+        self.cbStack = wx.CheckBox(self, label='Focus stack Z levels while scanning')
+        self.cbStack.SetValue(self.cfg.get('cam_stack', False))
+        self.AddRow('Stacking', self.cbStack)
+
+        vbox.Add(self.gs, proportion=0, flag=wx.ALL, border=5)
+        self.SetSizer(vbox)
+
 class CameraControl(wx.Panel):
     def __init__(self, parent, cfg, control):
         super().__init__(parent)
@@ -236,24 +353,61 @@ class CameraControl(wx.Panel):
         self.off_y = 0
         
         self.image_count = 0
-
+        self.cam_thread = None
+        self.run_thread = None
+        self.extra_cameras = {} # camera id -> (camera, grabber)
+        self.preview_visible = True
+
+        self.options = ScanOptions(parent, cfg)
+        self.mosaic = MosaicPanel(parent)
+        # the estimate walks every tile, it runs once the edits pause and
+        # is kept until something it depends on changes
+        self.estimate_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnEstimateTimer, self.estimate_timer)
+        self.estimate_key = None
+        self.estimate_text = ''
+        # any option change can move the estimate
+        for evt in (wx.EVT_CHOICE, wx.EVT_CHECKBOX, wx.EVT_SPINCTRL, wx.EVT_SPINCTRLDOUBLE):
+            self.options.Bind(evt, self.OnConfigChanged)
         self.InitUI()
         self.OnConfigChanged(None)
 
         self.Bind(wx.EVT_SIZE, self.OnSize)
 
-        self.cam_thread = None
-        self.run_thread = None
+        self.writer = ImageWriter()
 
     def Close(self):
         print('Close Cam')
         self.__savecfg()
-        if self.cam_thread and self.cam_thread.is_alive():
-            self.cam_thread.stop = True
-            self.cam_thread.join()
+        self.estimate_timer.Stop()
+        # the scan feeds the writer from the cameras, stop it first
         if self.run_thread and self.run_thread.is_alive():
             self.run_thread.stop = True
             self.run_thread.join()
+        if self.cam_thread and self.cam_thread.is_alive():
+            self.cam_thread.stop = True
+            self.cam_thread.join()
+        self.CloseExtraCameras()
+        self.writer.close()
+
+    def CloseExtraCameras(self):
+        for camera, grabber in self.extra_cameras.values():
+            grabber.stop = True
+            grabber.join()
+            camera.release()
+        self.extra_cameras = {}
+
+    def OpenExtraCameras(self, cam_ids):
+        for cam_id in cam_ids:
+            if cam_id == self.sbCamera.GetValue() or cam_id in self.extra_cameras:
+                continue
+            camera = open_camera(cam_id, cv2.CAP_DSHOW)
+            if camera is None:
+                wx.MessageBox(f'Unable to open camera {cam_id}', 'Camera Init Failure', wx.OK | wx.ICON_WARNING)
+                continue
+            width, height = camera_size(camera)
+            calib = self.cfg.get('cam_calibration', {}).get(str(cam_id))
+            self.extra_cameras[cam_id] = (camera, FrameGrabber(camera, square_crop(width, height), calib=calib))
 
     def __savecfg(self):
         self.cfg['cam_xstep'] = self.sbXSteps.GetValue()
@@ -262,6 +416,11 @@ class CameraControl(wx.Panel):
         self.cfg['cam_zlevels'] = self.sbZLevels.GetValue()
         self.cfg['cam_zstep'] = self.sbZStep.GetValue()
         self.cfg['cam_outdir'] = self.txtOutDir.GetValue()
+        self.options.SaveConfig()
+        if self.run_thread:
+            self.cfg['cam_settle_model'] = self.run_thread.settle.to_dict()
+            if self.run_thread.capture_cost is not None:
+                self.cfg['cam_capture_cost'] = round(self.run_thread.capture_cost, 4)
         print('Write cam cfg')
 
     def SetCameraRes(self, x, y):
@@ -302,15 +461,6 @@ class CameraControl(wx.Panel):
         self.Layout()
         self.CalcFrameData()
 
-    def take_picture(self, directory, name):
-        frame = self.cam_thread.get_raw_frame()
-        if frame is None:
-            return
-        #get the directory to save it in.
-        filename = os.path.join(directory, f'{name}.jpeg')
-        #save the image
-        cv2.imwrite(filename,frame)
-
     def OnInitCamera(self, event):
         print('Init Camera')
         if self.cam_thread is not None:
@@ -322,49 +472,82 @@ class CameraControl(wx.Panel):
         if self.run_thread is not None:
             self.run_thread.stop = True
             self.run_thread.join()
+            self.cfg['cam_settle_model'] = self.run_thread.settle.to_dict()
+            if self.run_thread.capture_cost is not None:
+                self.cfg['cam_capture_cost'] = round(self.run_thread.capture_cost, 4)
             del self.run_thread
             self.run_thread = None
 
         if self.camera and self.camera.isOpened():
             self.camera.release()
+        self.CloseExtraCameras()
 
         cam_id = self.sbCamera.GetValue()
-        self.camera = cv2.VideoCapture(cam_id, cv2.CAP_DSHOW)
-        if not self.camera.isOpened():
-            self.camera.release()
-            self.camera = None
+        self.camera = open_camera(cam_id, cv2.CAP_DSHOW)
+        if self.camera is None:
             self.video.SetBitmap(None)
             wx.MessageBox(f'Unable to open camera {cam_id}', 'Camera Init Failure', wx.OK | wx.ICON_WARNING)
             return
 
-        self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 10000)
-        self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 1000)
-        self.max_width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.max_height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        if self.max_width > self.max_height:
-            self.crop_width = self.crop_height = self.max_height
-            self.crop_x = (self.max_width - self.crop_width) // 2
-        else:
-            self.crop_width = self.crop_height = self.max_width
-            self.crop_y = (self.max_height - self.crop_height) // 2
+        self.max_width, self.max_height = camera_size(self.camera)
+        self.crop_x, self.crop_y, self.crop_width, self.crop_height = square_crop(self.max_width, self.max_height)
 
 
 
         self.CalcFrameData()
         print(self.max_width, self.max_height)
         if not self.cam_thread:
-            self.cam_thread = CamUpdateThread(self)
+            calib = self.cfg.get('cam_calibration', {}).get(str(cam_id))
+            # stream a small preview, switch to full resolution for scans
+            modes = camera_modes(self.max_width, self.max_height, self.options.sbPreviewWidth.GetValue())
+            self.cam_thread = CamUpdateThread(self, self.options.sbPreviewFps.GetValue(), calib, modes)
+            self.cam_thread.preview.active = self.preview_visible
+            self.OpenExtraCameras(self.options.ExtraCameras())
 
         if not self.run_thread:
             self.run_thread = CamRunThread(self, self.control)
+            self.run_thread.settle = SettleTracker(self.cfg.get('cam_settle_model', {}))
+            self.run_thread.capture_cost = self.cfg.get('cam_capture_cost', None)
 
         self.cfg['cam_id'] = cam_id
         
-    def UpdateProgress(self, index):
+    def UpdateProgress(self, index, timing=None):
         self.prog.SetValue(index)
-        self.txtProg.SetLabel(f'{index} of {self.image_count}')
+        stats = self.writer.stats()
+        label = f'{index} of {self.image_count} (write queue {stats["pending"]}, max {stats["max_depth"]})'
+        if timing:
+            phases = ' '.join(f'{p} {timing[p]:.2f}' for p in PHASES if p in timing)
+            if phases:
+                label += f'\n{phases}'
+            if 'eta' in timing:
+                label += f'  ETA {fmt_secs(timing["eta"])}'
+        self.txtProg.SetLabel(label)
     
+    def Estimate(self, x_steps, y_steps, inc, z_levels, z_step, order=None):
+        opts = self.options.GetOptions()
+        if order:
+            opts['order'] = order
+        if self.run_thread:
+            settle = self.run_thread.settle
+            if self.run_thread.capture_cost is not None:
+                opts['capture_cost'] = self.run_thread.capture_cost
+        else:
+            settle = SettleTracker(self.cfg.get('cam_settle_model', {}))
+            if self.cfg.get('cam_capture_cost', None) is not None:
+                opts['capture_cost'] = self.cfg.get('cam_capture_cost')
+        return ScanEstimate(x_steps, y_steps, inc, z_levels, z_step,
+                            self.control.jog_speed, self.control.jog_z_speed, opts,
+                            settle, self.control.arrive_poll)
+
+    def SetPreviewVisible(self, show):
+        # no point rendering a preview nobody can see
+        self.preview_visible = show
+        if self.cam_thread:
+            self.cam_thread.preview.active = show
+
     def OnConfigChanged(self, e):
+        if self.cam_thread:
+            self.cam_thread.preview.fps = self.options.sbPreviewFps.GetValue()
         x_steps = self.sbXSteps.GetValue()
         y_steps = self.sbYSteps.GetValue()
         inc = self.sbInc.GetValue()
@@ -377,10 +560,40 @@ class CameraControl(wx.Panel):
         
         self.image_count = (x_steps+1) * (y_steps+1) * z_levels
         
-        lbl = f'{x}x{y}mm {area}mm² {self.image_count} images'
-        
-        self.txtDetails.SetLabel(lbl)
+        self.details = f'{x}x{y}mm {area}mm² {self.image_count} images'
+        # the last estimate stands until the new one is in
+        self.txtDetails.SetLabel(self.details + '\n' + (self.estimate_text or 'Est. ...'))
         self.prog.SetRange(self.image_count)
+        self.estimate_timer.StartOnce(300)
+
+    def OnEstimateTimer(self, e):
+        self.txtDetails.SetLabel(self.details + '\n' + self.EstimateText())
+
+    def EstimateText(self):
+        x_steps = self.sbXSteps.GetValue()
+        y_steps = self.sbYSteps.GetValue()
+        inc = self.sbInc.GetValue()
+        z_levels = self.sbZLevels.GetValue()
+        z_step = self.sbZStep.GetValue()
+        opts = self.options.GetOptions()
+        key = repr((x_steps, y_steps, inc, z_levels, z_step, sorted(opts.items()),
+                    self.control.jog_speed, self.control.jog_z_speed))
+        if key == self.estimate_key:
+            return self.estimate_text
+
+        # both orderings so the faster one can be picked, the scan's own
+        # order is one of them
+        orders = ORDERS if z_levels > 1 else [opts['order']]
+        ests = {order: self.Estimate(x_steps, y_steps, inc, z_levels, z_step, order) for order in orders}
+        est = ests[opts['order']]
+        text = f'Est. {fmt_secs(est.total)}'
+        if z_levels > 1:
+            text += f' ({fmt_secs(max(est.levels))} per Z level)'
+            text += '\n' + ', '.join(f'{label} {fmt_secs(ests[order].total)}'
+                                     for label, order in zip(ScanOptions.ORDER_LABELS, ORDERS))
+        self.estimate_key = key
+        self.estimate_text = text
+        return text
 
     def InitUI(self):
         vbox = wx.BoxSizer(wx.VERTICAL)
@@ -443,6 +656,14 @@ class CameraControl(wx.Panel):
         self.btnFrame.Bind(wx.EVT_BUTTON, self.OnFrame)
         gs.Add(self.btnFrame, (1,7), flag=wx.EXPAND)
 
+        self.btnResume = wx.Button(self, label='Resume')
+        self.btnResume.Bind(wx.EVT_BUTTON, self.OnResume)
+        gs.Add(self.btnResume, (1,8), flag=wx.EXPAND)
+
+        self.btnFocus = wx.Button(self, label='Autofocus')
+        self.btnFocus.Bind(wx.EVT_BUTTON, self.OnAutofocus)
+        gs.Add(self.btnFocus, (0,9), flag=wx.EXPAND)
+
         self.btnOut = wx.Button(self, label='Out Dir')
         self.btnOut.Bind(wx.EVT_BUTTON, self.OnChooseDir)
         gs.Add(self.btnOut, (2,5), flag=wx.EXPAND)
@@ -461,11 +682,31 @@ class CameraControl(wx.Panel):
         vbox.Add(gs, proportion=0, flag=wx.ALL, border=5)
         self.SetSizer(vbox)
 
-    def CaptureComplete(self, state):
+    def on_scan_progress(self, index, timing=None):
+        self.UpdateProgress(index, timing)
+
+    def on_mosaic_start(self, canvas):
+        self.mosaic.SetCanvas(canvas)
+
+    def on_mosaic_update(self):
+        self.mosaic.UpdateTiles()
+
+    def on_scan_complete(self, state, errors):
+        self.CaptureComplete(state, errors)
+
+    def CaptureComplete(self, state, errors=None):
         self.btnStart.SetLabel('Start')
+        if errors:
+            msg = '\n'.join(f'{f}: {err}' for f, err in errors[:10])
+            if len(errors) > 10:
+                msg += f'\n... and {len(errors) - 10} more'
+            wx.MessageBox(f'{len(errors)} errors during the scan:\n{msg}', 'Scan Errors', wx.OK | wx.ICON_WARNING)
         if state:
             wx.MessageBox(f'Scan Complete!', 'Scan Complete!', wx.OK | wx.ICON_INFORMATION)
         self.DoComplete()
+        # the scan measured its capture cost, refresh the estimate
+        self.estimate_key = None
+        self.OnConfigChanged(None)
             
     def DoComplete(self):
         self.prog.SetValue(0)
@@ -497,9 +738,41 @@ class CameraControl(wx.Panel):
                     z_step = self.sbZStep.GetValue()
                     out_dir = self.txtOutDir.GetValue()
                     self.prog.SetValue(0)
-                    self.run_thread.do_run_capture(xsteps, ysteps, inc, z_levels, z_step, out_dir)
+                    opts = self.options.GetOptions()
+                    try:
+                        self.run_thread.do_run_capture(xsteps, ysteps, inc, z_levels, z_step, out_dir, opts)
+                    except ValueError as ex:
+                        wx.MessageBox(str(ex), 'Start', wx.OK | wx.ICON_WARNING)
+                        return
                     self.btnStart.SetLabel('Pause')
 
+    def OnResume(self, e):
+        if not (self.control.Connected() and self.run_thread) or self.run_thread.running_cap:
+            return
+        out_dir = self.txtOutDir.GetValue()
+        journal = load_journal(out_dir)
+        if journal is None:
+            wx.MessageBox(f'No scan journal found in {out_dir}', 'Resume', wx.OK | wx.ICON_WARNING)
+            return
+        if journal['complete']:
+            wx.MessageBox('This scan is already complete', 'Resume', wx.OK | wx.ICON_INFORMATION)
+            return
+
+        params = journal['params']
+        self.sbXSteps.SetValue(params['xsteps'])
+        self.sbYSteps.SetValue(params['ysteps'])
+        self.sbInc.SetValue(params['inc'])
+        self.sbZLevels.SetValue(params['z_levels'])
+        self.sbZStep.SetValue(params['z_step'])
+        self.OnConfigChanged(None)
+        try:
+            self.run_thread.do_resume_capture(out_dir, journal, self.options.GetOptions())
+        except ValueError as ex:
+            wx.MessageBox(f'{ex}, set the options back to resume', 'Resume', wx.OK | wx.ICON_WARNING)
+            return
+        self.prog.SetValue(len(journal['done']))
+        self.btnStart.SetLabel('Pause')
+
     def OnFrame(self, e):
         if self.control.Connected() and self.run_thread:
             x = self.sbXSteps.GetValue()
@@ -507,6 +780,14 @@ class CameraControl(wx.Panel):
             inc = self.sbInc.GetValue()
             self.run_thread.do_frame(x, y, inc)
 
+    def OnAutofocus(self, e):
+        if self.control.Connected() and self.run_thread and not self.run_thread.running_cap:
+            self.txtProg.SetLabel('Status: Focusing')
+            self.run_thread.do_autofocus(self.options.GetOptions())
+
+    def on_autofocus_complete(self, z, score):
+        self.txtProg.SetLabel(f'Status: Focus at Z{z:.3f} (score {score:.1f})')
+
     def OnChooseDir(self, e):
         print('Out Dir')
         dlg = wx.DirDialog(self, "Choose output directory", "",
@@ -0,0 +1,636 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from threading import Event
+
+BACKENDS = {
+    'any': None,
+    'dshow': 'CAP_DSHOW',
+    'msmf': 'CAP_MSMF',
+    'v4l2': 'CAP_V4L2',
+    'avfoundation': 'CAP_AVFOUNDATION',
+}
+
+
+class ScanReporter(object):
+    # Control and ScanRunner listener that prints one JSON object per line
+    def __init__(self, out):
+        self.out = out
+        self.start = time.time()
+        self.total = 0
+        self.writer = None
+        self.online = Event()
+        self.done = Event()
+        self.complete = False
+        self.errors = []
+        # the simulated machine, to check each tile is taken at rest
+        self.machine = None
+        self.moving_captures = 0
+
+    def emit(self, event, **data):
+        rec = {'event': event, 'time': round(time.time() - self.start, 3)}
+        rec.update(data)
+        self.out.write(json.dumps(rec) + '\n')
+        self.out.flush()
+
+    def on_control_online(self):
+        self.online.set()
+
+    def on_control_error(self):
+        self.emit('control_error')
+
+    def on_control_line_error(self, index, line, error):
+        self.emit('line_error', index=index, line=line, error=error)
+
+    def on_scan_capture(self, target):
+        if self.machine is None: return
+        pos, state = self.machine.position()
+        if state != 'Idle' or any(abs(p - t) > 0.01 for p, t in zip(pos, target)):
+            self.moving_captures += 1
+            self.emit('moving_capture', target=list(target), position=[round(p, 3) for p in pos], state=state)
+
+    def on_scan_progress(self, index, timing=None):
+        pending = self.writer.depth() if self.writer else 0
+        self.emit('progress', tile=index, total=self.total, write_queue=pending, timing=timing or {})
+
+    def on_scan_complete(self, state, errors):
+        self.complete = state
+        self.errors = errors
+        self.emit('complete', complete=state, errors=[{'file': f, 'error': e} for f, e in errors])
+        self.done.set()
+
+
+def process_stats():
+    res = {'cpu_time': round(time.process_time(), 3), 'peak_rss_mb': None}
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        res['peak_rss_mb'] = round(rss / (1024*1024 if sys.platform == 'darwin' else 1024), 1)
+    except ImportError:
+        pass # not available on Windows
+    return res
+
+def scan_opts(args):
+    return {
+        'settle_mode': args.settle_mode,
+        'settle_max': args.settle_max,
+        'settle_thresh': args.settle_thresh,
+        'stream': args.stream,
+        'stream_hold': args.stream_hold,
+        'stream_lookahead': args.lookahead,
+        'accel': args.accel,
+        'stack': args.stack,
+        'order': args.order,
+        'container': args.container,
+        'tile_format': args.tile_format,
+        'jpeg_quality': args.jpeg_quality,
+        'png_level': args.png_level,
+        'average': args.average,
+        'average_method': args.average_method,
+        'average_thresh': args.average_thresh,
+        'autofocus': args.autofocus,
+        'af_range': args.af_range,
+        'af_steps': args.af_steps,
+        'af_tol': args.af_tol,
+        'focus_map': args.focus_map,
+        'focus_points': args.focus_points,
+    }
+
+def given_opts(args):
+    # the scan options set on the command line, not left at their defaults
+    p = argparse.ArgumentParser()
+    add_scan_args(p)
+    defaults = scan_opts(p.parse_args(['--out', args.out]))
+    return {k: v for k, v in scan_opts(args).items() if v != defaults[k]}
+
+def cmd_scan(args, out):
+    import cv2
+    from . control import Control, Disconnected
+    from . grabber import FrameGrabber, open_camera, camera_size, square_crop
+    from . writer import ImageWriter
+    from . scan import ScanRunner, LAYOUT_OPTS, resume_options, check_storage
+    from . settle import SettleTracker
+    from . journal import load_journal
+    from . estimate import ScanEstimate
+    from . planner import ORDERS
+    from . dotconfig import Config
+
+    reporter = ScanReporter(out)
+
+    journal = None
+    if args.resume:
+        journal = load_journal(args.out)
+        if journal is None:
+            reporter.emit('error', message=f'no scan journal in {args.out}')
+            return 1
+        if journal['complete']:
+            reporter.emit('complete', complete=True, errors=[])
+            return 0
+        params = journal['params']
+        try:
+            opts = resume_options(params.get('opts', {}), given_opts(args))
+            check_storage(args.out, opts.get('container', LAYOUT_OPTS['container']))
+        except ValueError as ex:
+            reporter.emit('error', message=str(ex))
+            return 1
+        reporter.total = (params['xsteps']+1) * (params['ysteps']+1) * params['z_levels']
+    else:
+        if args.xsteps is None or args.ysteps is None:
+            reporter.emit('error', message='--xsteps and --ysteps are required')
+            return 1
+        try:
+            check_storage(args.out, args.container)
+        except ValueError as ex:
+            reporter.emit('error', message=str(ex))
+            return 1
+        reporter.total = (args.xsteps+1) * (args.ysteps+1) * args.zlevels
+    if not args.port and not args.sim:
+        reporter.emit('error', message='--port or --sim is required')
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    cfg = None if args.no_config else Config('PlotterCon', 'settings')
+    control = Control()
+    control.SetFirmware(args.firmware)
+    control.SetStreaming(args.char_count, args.rx_size)
+    control.pollThread.interval = args.status_poll
+    control.baud = args.baud
+    control.RegisterCallbackObject(reporter)
+
+    camera = grabber = writer = runner = server = None
+    extra = {} # camera id -> (camera, grabber)
+    try:
+        port = args.port
+        if args.sim:
+            from . sim import SimMachine, SimServer, SimCamera
+            machine = SimMachine(flavor=args.firmware, time_scale=args.sim_speed)
+            server = SimServer(machine, rx_size=args.rx_size if args.firmware == 'grbl' else None)
+            port = server.address
+            reporter.machine = machine
+
+        reporter.emit('connecting', port=port)
+        control.Connect(port)
+        if not reporter.online.wait(args.timeout):
+            reporter.emit('error', message=f'controller on {port} did not come online')
+            return 1
+
+        if args.sim:
+            focus = None
+            if args.sim_focus:
+                focus = tuple(float(v) for v in args.sim_focus.split(','))
+            camera = SimCamera(machine, focus=focus)
+        else:
+            backend = BACKENDS[args.backend]
+            camera = open_camera(args.camera, None if backend is None else getattr(cv2, backend))
+        if camera is None:
+            reporter.emit('error', message=f'unable to open camera {args.camera}')
+            return 1
+        width, height = camera_size(camera)
+        reporter.emit('camera', id=args.camera, width=width, height=height)
+
+        calib = cfg.get('cam_calibration', {}).get(str(args.camera)) if cfg and not args.sim else None
+        grabber = FrameGrabber(camera, square_crop(width, height), calib=calib)
+
+        for n, cam_id in enumerate(args.extra_camera or []):
+            if args.sim:
+                # another view of the same stage at a different magnification
+                cam = SimCamera(machine, px_per_mm=100.0 * (n + 1), seed=1234 + n + 1)
+            else:
+                cam = open_camera(cam_id, None if backend is None else getattr(cv2, backend))
+            if cam is None:
+                reporter.emit('error', message=f'unable to open camera {cam_id}')
+                return 1
+            w, h = camera_size(cam)
+            reporter.emit('camera', id=cam_id, width=w, height=h)
+            cal = cfg.get('cam_calibration', {}).get(str(cam_id)) if cfg and not args.sim else None
+            extra[cam_id] = (cam, FrameGrabber(cam, square_crop(w, h), calib=cal))
+
+        writer = ImageWriter()
+        reporter.writer = writer
+        runner = ScanRunner(control, grabber, writer, reporter, {c: g for c, (_, g) in extra.items()})
+        runner.settle = SettleTracker(cfg.get('cam_settle_model', {}) if cfg else None)
+        runner.capture_cost = cfg.get('cam_capture_cost', None) if cfg else None
+
+        # need a real status report before the origin is taken from Position()
+        try:
+            idle = control.WaitForArrival(timeout=args.timeout)
+        except Disconnected as ex:
+            reporter.emit('error', message=str(ex))
+            return 1
+        if not idle:
+            reporter.emit('error', message='controller is not idle')
+            return 1
+
+        if not journal:
+            opts = scan_opts(args)
+            if runner.capture_cost is not None:
+                opts['capture_cost'] = runner.capture_cost
+            totals = {}
+            for order in ORDERS:
+                est = ScanEstimate(args.xsteps, args.ysteps, args.inc, args.zlevels, args.zstep,
+                                   control.jog_speed, control.jog_z_speed, dict(opts, order=order),
+                                   runner.settle, control.arrive_poll)
+                totals[order] = round(est.total, 1)
+                if order == args.order:
+                    levels = [round(t, 1) for t in est.levels]
+            reporter.emit('estimate', total=totals[args.order], levels=levels, orders=totals)
+
+        if journal:
+            runner.do_resume_capture(args.out, journal, given_opts(args))
+        else:
+            runner.do_run_capture(args.xsteps, args.ysteps, args.inc, args.zlevels,
+                                  args.zstep, args.out, scan_opts(args))
+        try:
+            while not reporter.done.wait(0.5) and runner.is_alive():
+                pass
+        except KeyboardInterrupt:
+            reporter.emit('stopping')
+            runner.stop_cap = True
+            while not reporter.done.wait(0.5) and runner.is_alive():
+                pass
+        if not reporter.done.is_set():
+            reporter.emit('error', message='scan thread exited without completing')
+            return 1
+
+        stats = process_stats()
+        if server:
+            stats['rx_overflows'] = server.rx_overflows
+            stats['moving_captures'] = reporter.moving_captures
+        reporter.emit('stats', writer=writer.stats(), **stats)
+        if cfg is not None and not args.sim:
+            # what the sim learned says nothing about the real machine
+            cfg['cam_settle_model'] = runner.settle.to_dict()
+            if runner.capture_cost is not None:
+                cfg['cam_capture_cost'] = round(runner.capture_cost, 4)
+            cfg.write()
+        if reporter.complete and not reporter.errors and not reporter.moving_captures:
+            return 0
+        return 1
+    finally:
+        if runner:
+            runner.stop = True
+            runner.join()
+        if grabber:
+            grabber.stop = True
+            grabber.join()
+        for cam, extra_grabber in extra.values():
+            extra_grabber.stop = True
+            extra_grabber.join()
+            cam.release()
+        if writer:
+            writer.close()
+        if camera is not None:
+            camera.release()
+        control.Destroy()
+        if server:
+            server.stop = True
+
+
+def cmd_sim(args, out):
+    from . sim import SimMachine, SimServer
+    machine = SimMachine(flavor=args.firmware, time_scale=args.sim_speed)
+    server = SimServer(machine, port=args.port)
+    out.write(json.dumps({'event': 'listening', 'address': server.address}) + '\n')
+    out.flush()
+    try:
+        while server.is_alive():
+            server.join(0.5)
+    except KeyboardInterrupt:
+        server.stop = True
+        server.join()
+    return 0
+
+
+def cmd_send(args, out):
+    from . control import Control
+    reporter = ScanReporter(out)
+    if not args.port and not args.sim:
+        reporter.emit('error', message='--port or --sim is required')
+        return 1
+    if not os.path.isfile(args.file):
+        reporter.emit('error', message=f'no such file {args.file}')
+        return 1
+
+    control = Control()
+    control.SetFirmware(args.firmware)
+    control.SetStreaming(args.char_count, args.rx_size)
+    control.baud = args.baud
+    control.RegisterCallbackObject(reporter)
+    server = None
+    try:
+        port = args.port
+        if args.sim:
+            from . sim import SimMachine, SimServer
+            machine = SimMachine(flavor=args.firmware, time_scale=args.sim_speed)
+            server = SimServer(machine, rx_size=args.rx_size if args.firmware == 'grbl' else None)
+            port = server.address
+
+        reporter.emit('connecting', port=port)
+        control.Connect(port)
+        if not reporter.online.wait(args.timeout):
+            reporter.emit('error', message=f'controller on {port} did not come online')
+            return 1
+
+        last = [0.0]
+        def progress(sent, acked):
+            if time.time() - last[0] >= 0.5:
+                last[0] = time.time()
+                reporter.emit('progress', sent=sent, acked=acked)
+
+        start = time.time()
+        try:
+            sent = control.SendFile(args.file, progress)
+        except KeyboardInterrupt:
+            reporter.emit('stopping')
+            return 1
+        elapsed = time.time() - start
+        errors = control.LineErrors() # already reported as they came in
+        stats = {'lines': sent, 'seconds': round(elapsed, 3),
+                 'lines_per_s': round(sent / elapsed, 1) if elapsed > 0 else None}
+        if server:
+            stats['rx_overflows'] = server.rx_overflows
+        reporter.emit('complete', complete=control.Acked() >= sent, errors=len(errors), **stats)
+        return 1 if errors else 0
+    finally:
+        control.Destroy()
+        if server:
+            server.stop = True
+
+
+def cmd_stack(args, out):
+    from . stack import stack_scan
+    def emit(event, **data):
+        out.write(json.dumps(dict(event=event, **data)) + '\n')
+        out.flush()
+    def progress(done, total):
+        emit('progress', done=done, total=total)
+    errors = stack_scan(args.dir, args.out, args.workers, args.power, progress)
+    emit('complete', errors=[{'file': f, 'error': e} for f, e in errors])
+    return 1 if errors else 0
+
+
+def cmd_stitch(args, out):
+    from . stitch import stitch_scan
+    def emit(event, **data):
+        out.write(json.dumps(dict(event=event, **data)) + '\n')
+        out.flush()
+    def progress(stage, done, total):
+        emit('progress', stage=stage, done=done, total=total)
+    try:
+        layout = stitch_scan(args.dir, args.out, args.z, args.px_per_mm, args.workers, args.strip, progress)
+    except (IOError, ValueError) as ex:
+        emit('error', message=str(ex))
+        return 1
+    emit('complete', size=layout['size'], px_per_mm=round(layout['px_per_mm'], 3),
+         pairs=layout['pairs'], registered=layout['registered'])
+    return 0
+
+
+def cmd_pyramid(args, out):
+    import numpy as np
+    from . stitch import build_layout, load_layout, iter_strips, LAYOUT_SUFFIX
+    from . pyramid import export_strips, npy_strips
+    def emit(event, **data):
+        out.write(json.dumps(dict(event=event, **data)) + '\n')
+        out.flush()
+    def progress(stage, done, total):
+        emit('progress', stage=stage, done=done, total=total)
+    try:
+        # a stitched .npy, a saved layout, or straight from the scan grid
+        if args.src.lower().endswith('.npy'):
+            height, width = np.load(args.src, mmap_mode='r').shape[:2]
+            strips = npy_strips(args.src, args.strip)
+        else:
+            if args.src.lower().endswith('.json'):
+                layout = load_layout(args.src)
+            else:
+                layout = build_layout(args.src, args.z, args.px_per_mm, args.workers,
+                                      progress=lambda n, total: progress('register', n, total))
+            width, height = layout['size']
+            strips = iter_strips(layout, args.strip)
+        name = args.name
+        if not name:
+            name = os.path.basename(os.path.normpath(args.src))
+            if name.endswith(LAYOUT_SUFFIX):
+                name = name[:-len(LAYOUT_SUFFIX)]
+            name = os.path.splitext(name)[0] or 'scan'
+        writer = export_strips(strips, width, height, args.out, name,
+                               progress=lambda n, total: progress('render', n, total),
+                               tile_size=args.tile_size, fmt=args.format,
+                               quality=args.quality, workers=args.workers)
+    except (IOError, ValueError) as ex:
+        emit('error', message=str(ex))
+        return 1
+    emit('complete', dzi=writer.dzi_path, size=[width, height], tiles=writer.tiles)
+    return 0
+
+
+def cmd_calibrate(args, out):
+    import cv2
+    from . geometry import calibrate
+    from . grabber import open_camera
+    from . dotconfig import Config
+    def emit(event, **data):
+        out.write(json.dumps(dict(event=event, **data)) + '\n')
+        out.flush()
+    try:
+        board = tuple(int(v) for v in args.board.lower().split('x'))
+    except ValueError:
+        emit('error', message=f'bad board size {args.board}, expected e.g. 9x6')
+        return 1
+
+    images = []
+    if args.images:
+        for path in args.images:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                emit('error', message=f'unable to read {path}')
+                return 1
+            images.append(img)
+    else:
+        # grab frames with the board in view, move it between shots
+        backend = BACKENDS[args.backend]
+        camera = open_camera(args.camera, None if backend is None else getattr(cv2, backend))
+        if camera is None:
+            emit('error', message=f'unable to open camera {args.camera}')
+            return 1
+        try:
+            end = time.time() + args.timeout
+            while len(images) < args.frames and time.time() < end:
+                result, frame = camera.read()
+                if not result: continue
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                found, _ = cv2.findChessboardCorners(gray, board, cv2.CALIB_CB_FAST_CHECK)
+                if found:
+                    images.append(frame)
+                    emit('progress', frames=len(images), total=args.frames)
+                    time.sleep(args.interval)
+        finally:
+            camera.release()
+
+    try:
+        calib, rms, used = calibrate(images, board, args.square)
+    except ValueError as ex:
+        emit('error', message=str(ex))
+        return 1
+    emit('complete', camera=args.camera, rms=round(rms, 4), images=used, calibration=calib)
+    if not args.no_config:
+        cfg = Config('PlotterCon', 'settings')
+        cals = dict(cfg.get('cam_calibration', {}) or {})
+        cals[str(args.camera)] = calib
+        cfg['cam_calibration'] = cals
+        cfg.write()
+    return 0
+
+
+def cmd_bench(args, out):
+    from . bench import CASES, run_bench, compare
+    cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    for c in cases:
+        if c not in CASES:
+            out.write(json.dumps({'event': 'error', 'message': f'unknown case {c}'}) + '\n')
+            return 1
+    scan_args = [a for a in args.scan_args if a != '--']
+
+    results = run_bench(cases, scan_args, args.keep)
+    for case in results['cases']:
+        out.write(json.dumps(dict(event='case', **case)) + '\n')
+
+    path = args.json or time.strftime('bench-%Y%m%d-%H%M%S.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    out.write(json.dumps({'event': 'saved', 'path': path}) + '\n')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        out.write(json.dumps({'event': 'compare', 'baseline': baseline.get('version'),
+                              'lines': compare(results, baseline)}) + '\n')
+    out.flush()
+    return 0 if all(c['ok'] for c in results['cases']) else 1
+
+
+def add_scan_args(p):
+    p.add_argument('--port', help='controller serial device, or host:port')
+    p.add_argument('--sim', action='store_true', help='use the simulated controller and camera')
+    p.add_argument('--sim-speed', type=float, default=1.0, help='simulated machine speed-up')
+    p.add_argument('--sim-focus', metavar='Z0,DZDX,DZDY', help='simulated sample surface, out of focus blurs')
+    p.add_argument('--baud', type=int, default=115200)
+    p.add_argument('--firmware', default='smoothie', choices=['smoothie', 'grbl'])
+    p.add_argument('--char-count', action='store_true', help='character counting flow control (GRBL)')
+    p.add_argument('--rx-size', type=int, default=127, help='controller serial RX buffer size (bytes)')
+    p.add_argument('--camera', type=int, default=0, help='camera id')
+    p.add_argument('--backend', default='any', choices=list(BACKENDS))
+    p.add_argument('--extra-camera', type=int, action='append', metavar='ID',
+                   help='also capture every tile from this camera, into cam<ID>/ (repeatable)')
+    p.add_argument('--xsteps', type=int)
+    p.add_argument('--ysteps', type=int)
+    p.add_argument('--inc', type=float, default=1.0, help='step size (mm)')
+    p.add_argument('--zlevels', type=int, default=1)
+    p.add_argument('--zstep', type=float, default=0.0, help='Z step (mm)')
+    p.add_argument('--out', required=True, help='output directory')
+    p.add_argument('--resume', action='store_true', help='resume the scan journaled in --out')
+    p.add_argument('--settle-mode', default='fixed', choices=['fixed', 'adaptive'])
+    p.add_argument('--settle-max', type=float, default=1.0, help='settle time / upper bound (s)')
+    p.add_argument('--settle-thresh', type=float, default=1.5, help='adaptive settle motion threshold')
+    p.add_argument('--stream', action='store_true', help='stream moves to the controller')
+    p.add_argument('--stream-hold', type=float, default=0.25, help='stage hold per capture when streaming (s)')
+    p.add_argument('--lookahead', type=int, default=2, help='tiles queued ahead when streaming')
+    p.add_argument('--order', default='z_major', choices=['z_major', 'xy_major'],
+                   help='level by level, or every level at each position')
+    p.add_argument('--stack', action='store_true', help='focus stack each XY position as its Z levels complete')
+    p.add_argument('--average', type=int, default=1, help='frames averaged per tile')
+    p.add_argument('--average-method', default='mean', choices=['mean', 'median'])
+    p.add_argument('--average-thresh', type=float, default=2.0,
+                   help='grey level difference from the running mean that counts as motion')
+    p.add_argument('--autofocus', action='store_true', help='autofocus each tile, Z levels centre on the focus')
+    p.add_argument('--af-range', type=float, default=1.0, help='autofocus search range (mm)')
+    p.add_argument('--af-steps', type=int, default=7, help='autofocus coarse sweep steps')
+    p.add_argument('--af-tol', type=float, default=0.01, help='autofocus Z tolerance (mm)')
+    p.add_argument('--focus-map', default='off', choices=['off', 'plane', 'bilinear', 'tps'],
+                   help='autofocus a sparse grid first and follow the fitted surface')
+    p.add_argument('--focus-points', type=int, default=3, help='focus map points per axis')
+    p.add_argument('--container', action='store_true', help='store tiles in chunked container files, not a file each')
+    p.add_argument('--tile-format', default='jpeg', choices=['jpeg', 'png', 'raw'], help='tile encoding in a container')
+    p.add_argument('--jpeg-quality', type=int, default=95)
+    p.add_argument('--png-level', type=int, default=1, help='PNG compression level 0-9')
+    p.add_argument('--accel', type=float, default=500.0, help='machine acceleration for the estimate (mm/s²)')
+    p.add_argument('--timeout', type=float, default=15.0, help='connection timeout (s)')
+    p.add_argument('--status-poll', type=float, default=1.0, help='status query interval (s)')
+    p.add_argument('--no-config', action='store_true', help='do not load or save the user config')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='plottercon')
+    sub = parser.add_subparsers(dest='command')
+    add_scan_args(sub.add_parser('scan', help='run a capture scan without the GUI'))
+    p = sub.add_parser('send', help='send a G-code file to the controller')
+    p.add_argument('file', help='G-code file')
+    p.add_argument('--port', help='controller serial device, or host:port')
+    p.add_argument('--sim', action='store_true', help='use the simulated controller')
+    p.add_argument('--sim-speed', type=float, default=1.0, help='simulated machine speed-up')
+    p.add_argument('--baud', type=int, default=115200)
+    p.add_argument('--firmware', default='smoothie', choices=['smoothie', 'grbl'])
+    p.add_argument('--char-count', action='store_true', help='character counting flow control (GRBL)')
+    p.add_argument('--rx-size', type=int, default=127, help='controller serial RX buffer size (bytes)')
+    p.add_argument('--timeout', type=float, default=15.0, help='connection timeout (s)')
+    p = sub.add_parser('bench', help='benchmark scan throughput on simulated hardware')
+    p.add_argument('--cases', default='small,50x50,multiz', help='comma separated, from small, 50x50, multiz, stream')
+    p.add_argument('--json', help='results file, defaults to bench-<time>.json')
+    p.add_argument('--compare', help='earlier results file to compare against')
+    p.add_argument('--keep', action='store_true', help='keep the captured images')
+    p.add_argument('scan_args', nargs=argparse.REMAINDER, help='extra scan options after --')
+    p = sub.add_parser('stack', help='focus stack the Z levels of a scan')
+    p.add_argument('dir', help='scan output directory')
+    p.add_argument('--out', help='output directory, defaults to <dir>/stacked')
+    p.add_argument('--workers', type=int, help='worker processes, defaults to the CPU count')
+    p.add_argument('--power', type=float, default=2.0, help='sharpness weight exponent')
+    p = sub.add_parser('stitch', help='stitch a scan level into one image')
+    p.add_argument('dir', help='scan output directory, or its stacked directory')
+    p.add_argument('out', help='output image, .npy for a memory mapped array')
+    p.add_argument('--z', type=float, help='Z level to stitch, defaults to the first')
+    p.add_argument('--px-per-mm', type=float, help='image scale, measured from the overlaps if not given')
+    p.add_argument('--workers', type=int, help='worker processes, defaults to the CPU count')
+    p.add_argument('--strip', type=int, default=512, help='output rows blended at a time')
+    p = sub.add_parser('pyramid', help='export a deep zoom (DZI) tile pyramid')
+    p.add_argument('src', help='scan directory, stitch layout .json or stitched .npy')
+    p.add_argument('out', help='output directory')
+    p.add_argument('--name', help='pyramid name, defaults to the source name')
+    p.add_argument('--tile-size', type=int, default=256)
+    p.add_argument('--format', default='jpg', choices=['jpg', 'png'])
+    p.add_argument('--quality', type=int, default=90, help='JPEG quality')
+    p.add_argument('--z', type=float, help='Z level, defaults to the first')
+    p.add_argument('--px-per-mm', type=float, help='image scale, measured from the overlaps if not given')
+    p.add_argument('--workers', type=int, help='worker threads/processes, defaults to the CPU count')
+    p.add_argument('--strip', type=int, default=512, help='source rows read at a time')
+    p = sub.add_parser('calibrate', help='lens calibration from a chessboard')
+    p.add_argument('images', nargs='*', help='raw camera images of the board, grabbed from --camera if none')
+    p.add_argument('--camera', type=int, default=0, help='camera id, also the key the calibration is saved under')
+    p.add_argument('--backend', default='any', choices=list(BACKENDS))
+    p.add_argument('--board', default='9x6', help='inner corners, columns x rows')
+    p.add_argument('--square', type=float, default=1.0, help='square size (mm)')
+    p.add_argument('--frames', type=int, default=15, help='board views to grab')
+    p.add_argument('--interval', type=float, default=1.0, help='pause after each grabbed view (s)')
+    p.add_argument('--timeout', type=float, default=120.0, help='give up grabbing after (s)')
+    p.add_argument('--no-config', action='store_true', help='print the calibration without saving it')
+    p = sub.add_parser('sim', help='serve a simulated controller on a local TCP port')
+    p.add_argument('--firmware', default='smoothie', choices=['smoothie', 'grbl'])
+    p.add_argument('--port', type=int, default=0)
+    p.add_argument('--sim-speed', type=float, default=1.0, help='simulated machine speed-up')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        from . import main as gui_main
+        gui_main()
+        return
+
+    # progress lines own stdout, anything else printed goes to stderr
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        res = {'scan': cmd_scan, 'send': cmd_send, 'sim': cmd_sim, 'bench': cmd_bench,
+               'stack': cmd_stack, 'stitch': cmd_stitch, 'pyramid': cmd_pyramid,
+               'calibrate': cmd_calibrate}[args.command](args, out)
+    sys.exit(res)
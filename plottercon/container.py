@@ -0,0 +1,183 @@
+from threading import Lock
+import json
+import mmap
+import os
+import cv2
+import numpy as np
+
+INDEX_NAME = 'tiles.idx'
+CHUNK_NAME = 'tiles.{:03d}.dat'
+CHUNK_SIZE = 1 << 30
+# file extension for each tile encoding, the tile names keep the usual
+# Z{z}/Z..Y..X.. form with this extension
+TILE_FORMATS = {'jpeg': '.jpeg', 'png': '.png', 'raw': '.raw'}
+
+
+def encode_params(fmt, jpeg_quality=95, png_level=1):
+    if fmt == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+    if fmt == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(png_level)]
+    return []
+
+
+class ContainerWriter(object):
+    # Appends encoded tiles to a few large chunk files under root instead of
+    # one file per tile. Every tile gets a line in the index, written after
+    # its data, so a crash loses at most the tile being written. Used as the
+    # ImageWriter sink, write() is called from the writer threads.
+    def __init__(self, root, fmt='jpeg', jpeg_quality=95, png_level=1, chunk_size=CHUNK_SIZE):
+        if fmt not in TILE_FORMATS:
+            raise ValueError(f'unknown tile format {fmt}')
+        self.root = root
+        self.fmt = fmt
+        self.ext = TILE_FORMATS[fmt]
+        self.params = encode_params(fmt, jpeg_quality, png_level)
+        self.chunk_size = chunk_size
+        self.lock = Lock()
+        os.makedirs(root, exist_ok=True)
+        # carry on appending to the last chunk of an earlier run
+        self.chunk = 0
+        while os.path.exists(self.chunk_path(self.chunk + 1)):
+            self.chunk += 1
+        self.f = open(self.chunk_path(self.chunk), 'ab')
+        self.index = open(os.path.join(root, INDEX_NAME), 'ab')
+        if self.index.tell() > 0:
+            self.index.write(b'\n') # terminate a torn line left by a crash
+
+    def chunk_path(self, n):
+        return os.path.join(self.root, CHUNK_NAME.format(n))
+
+    def encode(self, frame):
+        # runs on the writer threads outside the lock
+        if self.fmt == 'raw':
+            return np.ascontiguousarray(frame)
+        ok, buf = cv2.imencode(self.ext, frame, self.params)
+        return buf if ok else None
+
+    def write(self, filename, buf, shape):
+        size = buf.nbytes
+        rec = {
+            'name': os.path.relpath(filename, self.root).replace(os.sep, '/'),
+            'format': self.fmt,
+            'shape': list(shape),
+            'size': size,
+        }
+        with self.lock:
+            if self.f.tell() > 0 and self.f.tell() + size > self.chunk_size:
+                self.f.close()
+                self.chunk += 1
+                self.f = open(self.chunk_path(self.chunk), 'ab')
+            rec['chunk'] = self.chunk
+            rec['offset'] = self.f.tell()
+            self.f.write(buf)
+            self.f.flush()
+            self.index.write((json.dumps(rec) + '\n').encode())
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            for f in (self.f, self.index):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+
+class TileContainer(object):
+    # Read side of ContainerWriter. The chunks are memory mapped, raw tiles
+    # come back as views of the map and encoded ones are decoded straight
+    # from it. refresh() picks up tiles added since, so a scan can be read
+    # while it is still running.
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}
+        self.maps = {}
+        self.index_pos = 0
+        self.refresh()
+
+    @staticmethod
+    def exists(root):
+        return os.path.isfile(os.path.join(root, INDEX_NAME))
+
+    def refresh(self):
+        path = os.path.join(self.root, INDEX_NAME)
+        if not os.path.isfile(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(self.index_pos)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break # still being written, read it next time
+                self.index_pos += len(line)
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # torn line from a crash
+                self.entries[rec['name']] = rec # a retaken tile replaces the old one
+
+    def names(self):
+        return list(self.entries)
+
+    def entry(self, name):
+        rec = self.entries.get(name)
+        if rec is None:
+            self.refresh()
+            rec = self.entries.get(name)
+        return rec
+
+    def chunk_map(self, n, end):
+        mm = self.maps.get(n)
+        if mm is None or len(mm) < end:
+            # the chunk has grown since it was mapped, the old map goes
+            # once no tile views are left on it
+            with open(os.path.join(self.root, CHUNK_NAME.format(n)), 'rb') as f:
+                mm = self.maps[n] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm
+
+    def data(self, name):
+        # the stored bytes of a tile as a uint8 array over the map
+        rec = self.entry(name)
+        if rec is None:
+            return None
+        mm = self.chunk_map(rec['chunk'], rec['offset'] + rec['size'])
+        return np.frombuffer(mm, np.uint8, rec['size'], rec['offset'])
+
+    def read(self, name, flags=cv2.IMREAD_COLOR):
+        data = self.data(name)
+        if data is None:
+            return None
+        rec = self.entries[name]
+        if rec['format'] != 'raw':
+            return cv2.imdecode(data, flags)
+        img = data.reshape(rec['shape'])
+        if flags == cv2.IMREAD_GRAYSCALE and img.ndim == 3:
+            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
+    def close(self):
+        self.maps = {}
+
+
+_containers = {}
+
+def find_container(path):
+    # the container holding a tile path, looked for in its parent directories
+    d = os.path.dirname(os.path.abspath(path))
+    while True:
+        if d in _containers or TileContainer.exists(d):
+            if d not in _containers:
+                _containers[d] = TileContainer(d)
+            return _containers[d], os.path.relpath(os.path.abspath(path), d).replace(os.sep, '/')
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None, None
+        d = parent
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    # cv2.imread() that also reads tiles stored in a container
+    if os.path.isfile(path):
+        return cv2.imread(path, flags)
+    container, name = find_container(path)
+    if container is None:
+        return None
+    return container.read(name, flags)
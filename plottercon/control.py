@@ -2,22 +2,24 @@ import logging
 logging.getLogger().setLevel(logging.ERROR) #suppress printcore crap
 import serial, serial.tools.list_ports
 from printrun.printcore import printcore
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
+from collections import deque
+import re
 import time
-from pubsub import pub
-import wx
 
-from . import events
-from . gcode import SMOO
+from . gcode import SMOO, FIRMWARE
+
+class Disconnected(IOError):
+    # the controller went away while waiting on it
+    pass
 
 class StatusPollThread(Thread):
-    def __init__(self):
+    def __init__(self, control):
         super().__init__()
+        self.control = control
         self.stop = False
         self.pause = True
-
-        pub.subscribe(self.status_on, "status_on")
-        pub.subscribe(self.status_off, "status_off")
+        self.interval = 1.0
         self.start()
 
     def status_on(self):
@@ -30,10 +32,18 @@ class StatusPollThread(Thread):
 
     def run(self):
         while not self.stop:
-            time.sleep(1.0)
-            if self.pause or wx.GetApp() is None:
+            time.sleep(self.interval)
+            if self.pause:
                 continue
-            wx.CallAfter(pub.sendMessage, "get_status")
+            self.control.GetStatus()
+
+
+def gcode_lines(lines):
+    # the commands of a G-code file, without comments and blank lines
+    for line in lines:
+        line = re.sub(r'\([^)]*\)', '', line.split(';')[0]).strip()
+        if line:
+            yield line
 
 
 CALLBACK_FUNCS = [
@@ -48,6 +58,7 @@ CALLBACK_FUNCS = [
     'on_control_preprintsend',
     'on_control_printsend',
     'on_control_status',
+    'on_control_line_error',
 ]
 
 class Control():
@@ -60,15 +71,39 @@ class Control():
         self.baud = 115200
         self.console_callbacks = {}
         self.cmd_map = SMOO
+        self.firmware = 'smoothie'
         self.pos = [0,0,0]
+        self.state = None
+        self.status_seq = 0
 
         self.jog_speed = 100
         self.jog_z_speed = 5
 
         self.pos_lock = Lock()
-
-        self.pollThread = StatusPollThread()
-        pub.subscribe(self.GetStatus, "get_status")
+        self.status_cond = Condition(self.pos_lock)
+        self.arrive_poll = 0.05
+
+        # every line sent (except realtime '?') gets exactly one ok/error back
+        self.send_lock = Lock()
+        self.ack_cond = Condition()
+        self.sent_count = 0
+        self.ack_count = 0
+        # lines sent but not acknowledged yet, (index, line, bytes)
+        self.in_flight = deque()
+        self.in_flight_bytes = 0
+        self.line_errors = []
+
+        # character counting: keep the controller's serial RX buffer full
+        # instead of waiting for each ok, see SetStreaming()
+        self.char_count = False
+        self.rx_size = 127
+
+        # printcore sends M105 to find the controller, GRBL comes online on
+        # its greeting and may still answer the M105 after it
+        self.online_quiet = 0.25
+        self.quiet_until = 0
+
+        self.pollThread = StatusPollThread(self)
 
     def Destroy(self):
         self.console_callbacks.clear()
@@ -106,6 +141,23 @@ class Control():
 
     def on_recv(self, line):
         line = line.strip()
+        if line.startswith('ok') or line.startswith('error'):
+            with self.ack_cond:
+                # only acks for our own lines, see online_quiet
+                sent = None
+                self.quiet_until = 0
+                if self.in_flight:
+                    self.ack_count += 1
+                    sent = self.in_flight.popleft()
+                    self.in_flight_bytes -= sent[2]
+                if not self.in_flight:
+                    self.in_flight_bytes = 0
+                if line.startswith('error') and sent is not None:
+                    self.line_errors.append((sent[0], sent[1], line))
+                    del self.line_errors[:-100]
+                self.ack_cond.notify_all()
+            if line.startswith('error') and sent is not None:
+                self.on_line_error(sent[0], sent[1], line)
         if line.startswith('ok'): return
         if not line.startswith('<'):
             self.__write("on_recv", line)
@@ -115,17 +167,22 @@ class Control():
         for cb in self.get_callbacks('on_control_recv'):
             cb(line)
 
+    def on_line_error(self, index, command, error):
+        self.__write("on_line_error", f'{index} {command}: {error}')
+        for cb in self.get_callbacks('on_control_line_error'):
+            cb(index, command, error)
+
     def on_connect(self):
         self.__write("on_connect")
         for cb in self.get_callbacks('on_control_connect'):
             cb()
-        events.poll_status_on()
+        self.pollThread.status_on()
 
     def on_disconnect(self):
         self.__write("on_disconnect")
         for cb in self.get_callbacks('on_control_disconnect'):
             cb()
-        events.poll_status_off()
+        self.pollThread.status_off()
 
     def on_error(self, error):
         self.__write("on_error", error)
@@ -134,6 +191,9 @@ class Control():
 
     def on_online(self):
         self.__write("on_online")
+        self.ResetAcks()
+        with self.ack_cond:
+            self.quiet_until = time.time() + self.online_quiet
         for cb in self.get_callbacks('on_control_online'):
             cb()
 
@@ -167,6 +227,7 @@ class Control():
         if i < 0: return False
 
         report = line[i+5:].split('|')[0]
+        state = line[1:].replace(',', '|').split('|')[0]
 
         split = report.split(',')
         res = []
@@ -183,10 +244,13 @@ class Control():
                 break
             if end: break
 
-        with self.pos_lock:
+        with self.status_cond:
             self.pos = []
             for i in range(len(res)):
                 self.pos.append(res[i])
+            self.state = state
+            self.status_seq += 1
+            self.status_cond.notify_all()
 
         return True
 
@@ -194,6 +258,42 @@ class Control():
         with self.pos_lock:
             return list(self.pos)
 
+    def State(self):
+        with self.pos_lock:
+            return self.state
+
+    def at_target(self, target, tol):
+        if self.state != 'Idle': return False
+        for i, v in enumerate(target):
+            if v is None: continue
+            if i >= len(self.pos) or abs(self.pos[i] - v) > tol:
+                return False
+        return True
+
+    def WaitForArrival(self, x=None, y=None, z=None, tol=0.01, timeout=None):
+        # query status quickly while the move is in flight, the reader thread
+        # wakes us as soon as a matching report comes in. False on timeout,
+        # raises Disconnected if there's no controller to wait on.
+        target = (x, y, z)
+        end = None if timeout is None else time.time() + timeout
+        with self.status_cond:
+            seq = self.status_seq
+        while self.Connected():
+            self.Send('?')
+            wait = self.arrive_poll
+            if end is not None:
+                wait = min(wait, end - time.time())
+                if wait <= 0: break
+            with self.status_cond:
+                self.status_cond.wait_for(lambda: self.status_seq != seq, wait)
+                if self.status_seq != seq:
+                    seq = self.status_seq
+                    if self.at_target(target, tol):
+                        return True
+        if not self.Connected():
+            raise Disconnected('controller disconnected')
+        return False
+
     def GetStatus(self):
         self.Send('?')
 
@@ -224,6 +324,26 @@ class Control():
     def gcode_abs_header(self):
         return 'G21 G52 G90' # metric, coord space, relative
 
+    def SetFirmware(self, name):
+        if name in FIRMWARE:
+            self.firmware = name
+            self.cmd_map = FIRMWARE[name]
+
+    def SetStreaming(self, enabled, rx_size=127):
+        # Character counting flow control for GRBL style firmware, which
+        # acknowledges every line and buffers rx_size bytes of input. Send()
+        # only blocks once the unacknowledged lines would overflow that.
+        with self.ack_cond:
+            self.char_count = bool(enabled)
+            self.rx_size = rx_size
+            self.ack_cond.notify_all()
+
+    def sync_cmd(self):
+        return self.cmd_map.get('sync', 'M400')
+
+    def dwell_cmd(self, secs):
+        return self.cmd_map.get('dwell', 'G4 S{:.3f}').format(secs)
+
     def move_cmd(self, x=None, y=None, z=None, speed=-1, rapid=True):
         res = 'G0 ' if rapid else 'G1 '
         if speed == -1:
@@ -261,9 +381,94 @@ class Control():
         if 'home_z' in self.cmd_map:
             self.Send(self.cmd_map['home_z'])
 
+    def ResetAcks(self):
+        with self.send_lock, self.ack_cond:
+            self.sent_count = 0
+            self.ack_count = 0
+            self.in_flight.clear()
+            self.in_flight_bytes = 0
+            self.ack_cond.notify_all()
+
+    def Acked(self):
+        with self.ack_cond:
+            return self.ack_count
+
+    def WaitForAck(self, index, timeout=None):
+        # wait until the line numbered index by Send() has been acknowledged
+        with self.ack_cond:
+            return self.ack_cond.wait_for(lambda: self.ack_count >= index, timeout)
+
+    def LineErrors(self):
+        # [(index, line, error)] reported since the last call
+        with self.ack_cond:
+            res = self.line_errors
+            self.line_errors = []
+            return res
+
+    def buffer_free(self, size):
+        if not self.char_count or not self.in_flight:
+            return True
+        return self.in_flight_bytes + size <= self.rx_size
+
+    def send_status_query(self):
+        # '?' is realtime, written bare: printcore would add a newline,
+        # which GRBL answers with an ok of its own and so takes a line's ack
+        if not self.Connected(): return
+        try:
+            self.pc.printer.write(b'?')
+        except Exception as ex:
+            print(f'Status query failed: {ex}')
+
     def Send(self, cmd):
-        if isinstance(cmd, (list, tuple)):
+        # returns the ack index of the last line sent, see WaitForAck()
+        if isinstance(cmd, str):
+            cmd = [cmd]
+        if len(cmd) == 1 and cmd[0].strip() == '?':
+            # not held up behind a Send() waiting for buffer space
+            self.send_status_query()
+            return self.sent_count
+        with self.send_lock:
             for c in cmd:
-                self.pc.send(c.strip())
-        elif isinstance(cmd, str):
-            self.pc.send(cmd.strip())
\ No newline at end of file
+                c = c.strip()
+                if not c: continue # GRBL would ok it, Smoothie not
+                if c == '?':
+                    self.send_status_query()
+                    continue
+                size = len(c) + 1
+                with self.ack_cond:
+                    while time.time() < self.quiet_until:
+                        self.ack_cond.wait(self.quiet_until - time.time())
+                    while not self.buffer_free(size) and self.Connected():
+                        self.ack_cond.wait(0.5)
+                    self.pc.send(c)
+                    self.sent_count += 1
+                    self.in_flight.append((self.sent_count, c, size))
+                    self.in_flight_bytes += size
+            return self.sent_count
+
+    def SendFile(self, src, progress=None, stopped=None):
+        # Send a G-code file (path or lines). Streamed when character
+        # counting is on, otherwise every line waits for its ok. Returns the
+        # number of lines sent, errors are reported through LineErrors().
+        f = open(src, 'r') if isinstance(src, str) else None
+        lines = gcode_lines(f if f is not None else src)
+        base = sent = ack = self.sent_count
+        try:
+            for line in lines:
+                if stopped and stopped(): break
+                if not self.Connected(): break
+                ack = self.Send(line)
+                sent += 1
+                if not self.char_count:
+                    while not self.WaitForAck(ack, timeout=0.5):
+                        if not self.Connected() or (stopped and stopped()): break
+                if progress:
+                    progress(sent - base, self.Acked() - base)
+            while not self.WaitForAck(ack, timeout=0.5):
+                if not self.Connected() or (stopped and stopped()): break
+            if progress:
+                progress(sent - base, self.Acked() - base)
+        finally:
+            if f is not None:
+                f.close()
+        return sent - base
\ No newline at end of file
@@ -0,0 +1,101 @@
+import math
+from . planner import scan_order
+
+DEFAULT_ACCEL = 500.0 # mm/s², matches the simulator
+DEFAULT_CAPTURE = 0.05 # per tile overhead (s) before anything is measured
+
+
+def move_profile(dist, speed, accel):
+    # trapezoidal velocity profile, returns (accel time, cruise time, peak speed)
+    if dist <= 0 or speed <= 0:
+        return 0.0, 0.0, 0.0
+    if accel <= 0:
+        return 0.0, dist / speed, speed
+    if dist >= speed * speed / accel:
+        return speed / accel, (dist - speed * speed / accel) / speed, speed
+    peak = math.sqrt(dist * accel)
+    return peak / accel, 0.0, peak
+
+def move_time(dist, speed, accel):
+    ta, tc, _ = move_profile(dist, speed, accel)
+    return 2*ta + tc
+
+def move_distance(t, dist, speed, accel):
+    # distance covered t seconds into a move
+    ta, tc, peak = move_profile(dist, speed, accel)
+    if t <= 0: return 0.0
+    if ta == 0:
+        return min(dist, peak * t)
+    if t < ta:
+        return 0.5 * accel * t * t
+    d = 0.5 * accel * ta * ta
+    if t < ta + tc:
+        return d + peak * (t - ta)
+    d += peak * tc
+    t = min(t - ta - tc, ta)
+    return min(dist, d + peak * t - 0.5 * accel * t * t)
+
+
+class ScanEstimate(object):
+    # Travel-time model of a scan. Walks the tiles in the order the scan
+    # runs them and keeps the predicted time at the end of every tile, so
+    # a running scan can compare its elapsed time with the model.
+    def __init__(self, xsteps, ysteps, inc, z_levels, z_step, speed, z_speed,
+                 opts=None, settle_model=None, arrive_poll=0.05):
+        opts = opts or {}
+        self.accel = opts.get('accel', DEFAULT_ACCEL)
+        self.capture = opts.get('capture_cost', DEFAULT_CAPTURE)
+        self.settle_mode = opts.get('settle_mode', 'fixed')
+        self.settle_max = opts.get('settle_max', 1.0)
+        self.stream = opts.get('stream', False)
+        self.stream_hold = opts.get('stream_hold', 0.25)
+        self.order = opts.get('order', 'z_major')
+        self.settle_model = settle_model
+        # WaitForArrival only notices the stop on its next status poll
+        self.arrive_latency = 0 if self.stream else arrive_poll / 2
+
+        self.speed = speed
+        self.z_speed = z_speed
+        self.tiles = []
+
+        # time spent on each level's tiles, whatever the order
+        self.levels = [0.0] * z_levels
+
+        t = 0.0
+        last = (0.0, 0.0, 0.0)
+        z_range = [i * z_step for i in range(z_levels)]
+        for zi, z, iy, ix, x, y in scan_order(0, 0, inc, xsteps, ysteps, z_range, self.order):
+            dt = self.tile_time(last, (x, y, z))
+            t += dt
+            self.levels[zi] += dt
+            self.tiles.append(t)
+            last = (x, y, z)
+        # return to the origin
+        t += move_time(math.hypot(last[0], last[1]), speed, self.accel)
+        t += move_time(abs(last[2]), z_speed, self.accel)
+        self.total = t
+
+    def settle_time(self, dist):
+        if self.stream or self.settle_mode != 'adaptive' or self.settle_model is None:
+            return self.settle_max
+        return min(self.settle_max, self.settle_model.predict(dist, self.settle_max))
+
+    def tile_time(self, start, end):
+        # Z and XY are sent as separate moves and run one after the other
+        dx, dy, dz = [abs(e - s) for s, e in zip(start, end)]
+        t = move_time(math.hypot(dx, dy), self.speed, self.accel)
+        t += move_time(dz, self.z_speed, self.accel) + self.arrive_latency
+        t += self.settle_time(dx + dy + dz)
+        if self.stream:
+            # the capture overlaps the hold dwell and the next move
+            return t + self.stream_hold
+        return t + self.capture
+
+    def at(self, index):
+        # predicted time once index tiles are done
+        if index <= 0 or not self.tiles:
+            return 0.0
+        return self.tiles[min(index, len(self.tiles)) - 1]
+
+    def remaining(self, index, ratio=1.0):
+        return max(0.0, self.total - self.at(index)) * ratio
@@ -0,0 +1,113 @@
+import math
+import time
+import cv2
+import numpy as np
+
+FOCUS_SIZE = 256
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+def focus_score(frame, roi=0.5, size=FOCUS_SIZE):
+    # variance of the Laplacian over the centre roi (a fraction of the
+    # frame), downscaled to at most size px so it costs the same at any
+    # camera resolution
+    h, w = frame.shape[:2]
+    rw, rh = max(1, int(w * roi)), max(1, int(h * roi))
+    x0, y0 = (w - rw) // 2, (h - rh) // 2
+    part = frame[y0:y0 + rh, x0:x0 + rw]
+    scale = size / max(rw, rh)
+    if scale < 1:
+        part = cv2.resize(part, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if part.ndim == 3:
+        part = cv2.cvtColor(part, cv2.COLOR_BGR2GRAY)
+    lap = cv2.Laplacian(part, cv2.CV_32F)
+    _, std = cv2.meanStdDev(lap)
+    return float(std[0, 0] ** 2)
+
+
+class AutoFocus(object):
+    # Finds the sharpest Z at the current XY position. A coarse sweep over
+    # the range picks the best step, golden-section search then narrows
+    # the bracket around it. Scores are kept per Z (to the machine's
+    # resolution, move_cmd() sends Z to 0.01 mm) so no height is measured
+    # twice; search() can be called again with a narrower range and reuses
+    # them.
+    def __init__(self, control, grabber, z_speed=None, settle=0.1, roi=0.5,
+                 resolution=0.01, stopped=None):
+        self.control = control
+        self.grabber = grabber
+        self.z_speed = z_speed or control.jog_z_speed
+        self.settle = settle
+        self.roi = roi
+        self.resolution = resolution
+        self.stopped = stopped
+        self.scores = {}
+        self.moves = 0
+
+    def key(self, z):
+        return round(round(z / self.resolution) * self.resolution, 6)
+
+    def score_at(self, z):
+        z = self.key(z)
+        if z in self.scores:
+            return self.scores[z]
+        if self.stopped and self.stopped():
+            return 0.0
+        self.control.Send(self.control.move_cmd(z=z, speed=self.z_speed))
+        self.moves += 1
+        while not self.control.WaitForArrival(z=z, timeout=1.0):
+            if self.stopped and self.stopped(): return 0.0
+        if self.settle:
+            time.sleep(self.settle)
+        # the next frame may have been exposed before now, take the one after
+        seq = self.grabber.frame_seq()
+        res = None
+        for i in range(2):
+            res = self.grabber.wait_frame(seq, 1.0)
+            if res is None: break
+            seq = res[0]
+        frame = res[1] if res else self.grabber.get_raw_frame()
+        if frame is None:
+            return 0.0
+        score = self.scores[z] = focus_score(frame, self.roi)
+        return score
+
+    def best(self, lo=-math.inf, hi=math.inf):
+        inside = [(s, z) for z, s in self.scores.items() if lo <= z <= hi]
+        if not inside:
+            return None, 0.0
+        s, z = max(inside)
+        return z, s
+
+    def search(self, center, span, steps=7, tol=0.01):
+        # returns (z, score) of the sharpest height within center +- span/2,
+        # (None, 0.0) if nothing could be scored (stopped, or no frames).
+        # The bounds are rounded like the score keys so the ends count.
+        lo, hi = self.key(center - span / 2), self.key(center + span / 2)
+        zs = np.linspace(lo, hi, max(3, steps))
+        # sweep from the end nearest the current height
+        here = self.control.Position()[2]
+        if abs(zs[-1] - here) < abs(zs[0] - here):
+            zs = zs[::-1]
+        for z in zs:
+            self.score_at(z)
+        zs = sorted(zs)
+        z0, _ = self.best(lo, hi)
+        if z0 is None:
+            return None, 0.0
+        i = min(range(len(zs)), key=lambda n: abs(zs[n] - z0))
+        a, b = zs[max(0, i - 1)], zs[min(len(zs) - 1, i + 1)]
+
+        # golden-section on [a, b], one new height per step
+        c = b - GOLDEN * (b - a)
+        d = a + GOLDEN * (b - a)
+        while b - a > tol and not (self.stopped and self.stopped()):
+            if self.score_at(c) >= self.score_at(d):
+                b, d = d, c
+                c = b - GOLDEN * (b - a)
+            else:
+                a, c = c, d
+                d = a + GOLDEN * (b - a)
+            if self.key(c) == self.key(d):
+                break # down to the machine's resolution
+        return self.best(lo, hi)
@@ -0,0 +1,102 @@
+import numpy as np
+
+METHODS = ['plane', 'bilinear', 'tps']
+
+
+def sample_grid(x0, y0, width, height, points):
+    # points x points positions over the scan area, in serpentine order
+    nx = 1 if width == 0 else max(2, points)
+    ny = 1 if height == 0 else max(2, points)
+    xs = np.linspace(x0, x0 + width, nx)
+    ys = np.linspace(y0, y0 + height, ny)
+    res = []
+    for iy, y in enumerate(ys):
+        row = xs if iy % 2 == 0 else xs[::-1]
+        res.extend((round(float(x), 4), round(float(y), 4)) for x in row)
+    return res
+
+def tps_kernel(r):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = r * r * np.log(r)
+    return np.nan_to_num(k)
+
+
+class FocusMap(object):
+    # Sample surface height as a function of XY, fitted to focus points
+    # [(x, y, z)]. plane is a least squares tilt, bilinear interpolates the
+    # pre-scan grid (clamped outside it), tps is a thin plate spline through
+    # every point (smoothed by smooth). Falls back to a plane, or a constant,
+    # when there are too few points for the method.
+    def __init__(self, points, method='plane', smooth=0.0):
+        self.points = [tuple(float(v) for v in p) for p in points]
+        if not self.points:
+            raise ValueError('no focus points')
+        self.method = method if method in METHODS else 'plane'
+        self.smooth = smooth
+        pts = np.array(self.points)
+        self.xy = pts[:, :2]
+        self.z = pts[:, 2]
+        self.xs = np.unique(self.xy[:, 0])
+        self.ys = np.unique(self.xy[:, 1])
+        if self.method == 'bilinear' and len(self.points) != len(self.xs) * len(self.ys):
+            self.method = 'tps' # not a full grid
+        if self.method == 'tps' and len(self.points) < 4:
+            self.method = 'plane'
+        self.fit()
+
+    def fit(self):
+        n = len(self.points)
+        if self.method == 'bilinear':
+            self.grid = np.full((len(self.ys), len(self.xs)), np.nan)
+            for (x, y), z in zip(self.xy, self.z):
+                self.grid[np.searchsorted(self.ys, y), np.searchsorted(self.xs, x)] = z
+        elif self.method == 'tps':
+            r = np.hypot(*(self.xy[:, None, :] - self.xy[None, :, :]).transpose(2, 0, 1))
+            a = np.zeros((n + 3, n + 3))
+            a[:n, :n] = tps_kernel(r) + np.eye(n) * self.smooth
+            a[:n, n] = a[n, :n] = 1
+            a[:n, n + 1:] = self.xy
+            a[n + 1:, :n] = self.xy.T
+            b = np.concatenate([self.z, np.zeros(3)])
+            self.coef = np.linalg.lstsq(a, b, rcond=None)[0]
+        else:
+            # z = c + dx * x + dy * y, or just the mean without enough spread
+            a = np.column_stack([np.ones(n), self.xy])
+            cols = [0] + [i + 1 for i, v in enumerate((self.xs, self.ys)) if len(v) > 1]
+            coef = np.linalg.lstsq(a[:, cols], self.z, rcond=None)[0]
+            self.coef = np.zeros(3)
+            self.coef[cols] = coef
+
+    def predict(self, x, y):
+        if self.method == 'bilinear':
+            return float(self.bilinear(x, y))
+        if self.method == 'tps':
+            n = len(self.points)
+            r = np.hypot(self.xy[:, 0] - x, self.xy[:, 1] - y)
+            w = self.coef
+            return float(tps_kernel(r) @ w[:n] + w[n] + w[n + 1] * x + w[n + 2] * y)
+        return float(self.coef[0] + self.coef[1] * x + self.coef[2] * y)
+
+    def bilinear(self, x, y):
+        def cell(v, axis):
+            if len(axis) == 1:
+                return 0, 0, 0.0
+            v = min(max(v, axis[0]), axis[-1])
+            i = min(max(np.searchsorted(axis, v) - 1, 0), len(axis) - 2)
+            return i, i + 1, (v - axis[i]) / (axis[i + 1] - axis[i])
+        x0, x1, fx = cell(x, self.xs)
+        y0, y1, fy = cell(y, self.ys)
+        g = self.grid
+        top = g[y0, x0] * (1 - fx) + g[y0, x1] * fx
+        bottom = g[y1, x0] * (1 - fx) + g[y1, x1] * fx
+        return top * (1 - fy) + bottom * fy
+
+    def residuals(self):
+        return [z - self.predict(x, y) for (x, y), z in zip(self.xy, self.z)]
+
+    def to_dict(self):
+        return {'method': self.method, 'smooth': self.smooth, 'points': [list(p) for p in self.points]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['points'], data.get('method', 'plane'), data.get('smooth', 0.0))
@@ -1,4 +1,17 @@
 SMOO = {
     'home_all': 'G28.2 XY',
     'home_z':   'G28.2 Z',
-}
\ No newline at end of file
+    'sync':     'M400',
+    'dwell':    'G4 S{:.3f}', # seconds
+}
+
+GRBL = {
+    'home_all': '$H',
+    'sync':     'G4 P0',
+    'dwell':    'G4 P{:.3f}', # seconds
+}
+
+FIRMWARE = {
+    'smoothie': SMOO,
+    'grbl':     GRBL,
+}
@@ -0,0 +1,130 @@
+from threading import Lock
+import cv2
+import numpy as np
+
+# maps are kept per (frame size, crop, rotation, calibration, output size)
+_cache = {}
+_cache_lock = Lock()
+
+
+def scaled_camera_matrix(calib, width, height):
+    # the calibration may have been taken at another resolution
+    k = np.array(calib['camera_matrix'], np.float64)
+    cw, ch = calib.get('size', (width, height))
+    k[0] *= width / cw
+    k[1] *= height / ch
+    return k
+
+def build_maps(frame_size, crop=None, rotate=True, calib=None, out_size=None):
+    # for every output pixel, where to sample the camera frame: output ->
+    # crop -> rotated frame -> undistorted frame -> distorted source
+    width, height = frame_size
+    cx, cy, cw, ch = crop or (0, 0, width, height)
+    ow, oh = out_size or (cw, ch)
+    xs = (np.arange(ow, dtype=np.float32) + 0.5) * (cw / ow) - 0.5 + cx
+    ys = (np.arange(oh, dtype=np.float32) + 0.5) * (ch / oh) - 0.5 + cy
+    if rotate:
+        xs = (width - 1) - xs
+        ys = (height - 1) - ys
+    map_x, map_y = np.meshgrid(xs, ys)
+
+    if calib:
+        k = scaled_camera_matrix(calib, width, height)
+        d = np.array(calib['dist_coeffs'], np.float64)
+        ux, uy = cv2.initUndistortRectifyMap(k, d, None, k, (width, height), cv2.CV_32FC1)
+        # sample the full frame undistort maps at our coordinates
+        src_x = cv2.remap(ux, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        src_y = cv2.remap(uy, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        map_x, map_y = src_x, src_y
+
+    # fixed point maps are about twice as fast to apply
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+def calib_key(calib):
+    if not calib:
+        return None
+    return (tuple(np.ravel(calib['camera_matrix'])), tuple(np.ravel(calib['dist_coeffs'])),
+            tuple(calib.get('size', ())))
+
+def get_maps(frame_size, crop=None, rotate=True, calib=None, out_size=None):
+    key = (tuple(frame_size), tuple(crop) if crop else None, rotate, calib_key(calib),
+           tuple(out_size) if out_size else None)
+    with _cache_lock:
+        maps = _cache.get(key)
+    if maps is None:
+        maps = build_maps(frame_size, crop, rotate, calib, out_size)
+        with _cache_lock:
+            _cache[key] = maps
+    return maps
+
+
+class Geometry(object):
+    # Frame correction for one camera: 180 degree rotation, crop, lens
+    # undistortion and an optional output size in a single pass. Without a
+    # calibration or resize the plain rotate is used, it is the same single
+    # pass and a bit cheaper than remap.
+    def __init__(self, crop=None, calib=None, rotate=True, out_size=None):
+        self.crop = crop
+        self.calib = calib
+        self.rotate = rotate
+        self.out_size = out_size
+
+    def simple(self):
+        return not self.calib and not self.out_size
+
+    def output_shape(self, frame_shape):
+        if self.out_size:
+            w, h = self.out_size
+        elif self.crop:
+            w, h = self.crop[2:]
+        else:
+            h, w = frame_shape[:2]
+        return (h, w) + tuple(frame_shape[2:])
+
+    def apply(self, frame, dst=None):
+        if self.simple():
+            if self.crop:
+                # crop the mirrored region so rotating it gives the crop
+                x, y, w, h = self.crop
+                fh, fw = frame.shape[:2]
+                frame = frame[fh-y-h:fh-y, fw-x-w:fw-x] if self.rotate else frame[y:y+h, x:x+w]
+            if not self.rotate:
+                if dst is None:
+                    return frame.copy()
+                np.copyto(dst, frame)
+                return dst
+            return cv2.rotate(frame, cv2.ROTATE_180, dst=dst)
+        h, w = frame.shape[:2]
+        m1, m2 = get_maps((w, h), self.crop, self.rotate, self.calib, self.out_size)
+        return cv2.remap(frame, m1, m2, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_CONSTANT)
+
+
+def calibrate(images, board=(9, 6), square=1.0):
+    # chessboard calibration from a list of BGR images, returns the
+    # calibration dict Geometry takes plus the RMS reprojection error
+    objp = np.zeros((board[0] * board[1], 3), np.float32)
+    objp[:, :2] = np.mgrid[0:board[0], 0:board[1]].T.reshape(-1, 2) * square
+    obj_points, img_points = [], []
+    size = None
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    for img in images:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if size is None:
+            size = gray.shape[::-1]
+        elif gray.shape[::-1] != size:
+            continue
+        found, corners = cv2.findChessboardCorners(gray, board, None)
+        if not found:
+            continue
+        corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+        obj_points.append(objp)
+        img_points.append(corners)
+    if len(obj_points) < 3:
+        raise ValueError(f'chessboard found in {len(obj_points)} images, need at least 3')
+    rms, k, d, _, _ = cv2.calibrateCamera(obj_points, img_points, size, None, None)
+    calib = {
+        'camera_matrix': k.tolist(),
+        'dist_coeffs': d.ravel().tolist(),
+        'size': list(size),
+    }
+    return calib, rms, len(obj_points)
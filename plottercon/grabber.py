@@ -0,0 +1,218 @@
+from threading import Thread, Lock, Condition
+import time
+import cv2
+import numpy as np
+from . settle import small_frame, SETTLE_SIZE
+from . geometry import Geometry
+
+
+def open_camera(cam_id, backend=None, width=10000, height=1000):
+    # ask for a silly resolution so the driver picks its maximum
+    if backend is None:
+        camera = cv2.VideoCapture(cam_id)
+    else:
+        camera = cv2.VideoCapture(cam_id, backend)
+    if not camera.isOpened():
+        camera.release()
+        return None
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    return camera
+
+def camera_size(camera):
+    return int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)), int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+def camera_modes(width, height, preview_width):
+    # FrameGrabber modes, a small preview stream and full size stills
+    if not preview_width or preview_width >= width:
+        return None
+    preview_height = int(round(height * preview_width / width)) & ~1
+    return {'preview': (preview_width, preview_height), 'still': (width, height)}
+
+def square_crop(width, height):
+    # centred square crop, returns (x, y, w, h)
+    if width > height:
+        return (width - height) // 2, 0, height, height
+    return 0, (height - width) // 2, width, width
+
+
+class FrameGrabber(Thread):
+    # Reads the camera continuously at its own frame rate, corrects each
+    # frame (rotate, crop, undistort, see Geometry) in one pass and keeps
+    # the latest one along with a small grey copy for
+    # motion checks. No GUI dependencies, the preview runs separately in a
+    # PreviewThread so it never holds up the grab.
+    #
+    # Frames go into a small ring of preallocated buffers and the newest
+    # finished one is published as a (seq, raw, small) tuple that readers
+    # pick up without locking. A published frame is left alone for at
+    # least buffers - 2 further frames, copy it to keep it longer.
+    #
+    # crop is (x, y, w, h) or a function of the frame size. modes, if
+    # given, is {'preview': (w, h), 'still': (w, h)}: the camera streams
+    # at the preview size and set_mode('still') switches it to full size,
+    # e.g. for the length of a scan.
+    def __init__(self, camera, crop=None, interval=0, buffers=4, calib=None, modes=None):
+        super().__init__()
+        self.camera = camera
+        self.crop = crop
+        self.calib = calib
+        self.geometries = {}
+        self.modes = modes
+        self.mode = None
+        self.want_mode = 'preview' if modes else None
+        # set_mode() bumps mode_gen, ready_gen is the newest request a frame
+        # has been captured for
+        self.mode_gen = 0
+        self.ready_gen = 0
+        self.switch_discard = 2
+        self.interval = interval
+        self.buffers = max(3, buffers)
+        self.pool = []
+        self.slot = 0
+        self.read_buf = None
+        self.gray = None
+        self.latest = (0, None, None)
+        self.raw_frame = None
+        self.small = None
+        self.seq = 0
+        self.frame_time = 0
+        self.period = 0 # average time between frames
+        self.stop = False
+        self.lock = Lock()
+        self.frame_cond = Condition(self.lock)
+        self.start()
+
+    def alloc(self, shape):
+        self.pool = [(np.empty(shape, np.uint8), np.empty(SETTLE_SIZE[::-1], np.uint8))
+                     for i in range(self.buffers)]
+        self.gray = np.empty(shape[:2], np.uint8)
+        self.slot = 0
+
+    def geometry(self, width, height):
+        geometry = self.geometries.get((width, height))
+        if geometry is None:
+            crop = self.crop(width, height) if callable(self.crop) else self.crop
+            geometry = self.geometries[(width, height)] = Geometry(crop, self.calib)
+        return geometry
+
+    def set_mode(self, name, timeout=5.0):
+        # returns once frames in the new mode are coming through
+        if not self.modes or name not in self.modes:
+            return True
+        with self.frame_cond:
+            if name == self.mode and name == self.want_mode:
+                return True
+            self.want_mode = name
+            self.mode_gen += 1
+            gen = self.mode_gen
+            return self.frame_cond.wait_for(lambda: self.ready_gen >= gen, timeout)
+
+    def apply_mode(self, name):
+        # only called from the grab loop, the one thread using the camera
+        width, height = self.modes[name]
+        self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        for i in range(self.switch_discard):
+            self.camera.read() # frames still queued at the old size
+        self.read_buf = None
+        self.mode = name
+
+    def capture(self):
+        if self.camera is None:
+            return False
+        # the request this frame is taken for, a later one waits for the next
+        with self.lock:
+            want, gen = self.want_mode, self.mode_gen
+        if want != self.mode:
+            self.apply_mode(want)
+
+        # read() blocks until the camera has a new frame, readers only wait
+        # for the swap below
+        result, frame = self.camera.read(self.read_buf)
+        if not result:
+            return False
+        self.read_buf = frame # the camera refills it next time
+
+        geometry = self.geometry(frame.shape[1], frame.shape[0])
+        shape = geometry.output_shape(frame.shape)
+        if not self.pool or self.pool[0][0].shape != shape:
+            self.alloc(shape)
+        raw, small = self.pool[self.slot]
+        self.slot = (self.slot + 1) % len(self.pool)
+        geometry.apply(frame, raw)
+        small_frame(raw, self.gray, small)
+
+        with self.lock:
+            self.seq += 1
+            self.raw_frame = raw
+            self.small = small
+            self.latest = (self.seq, raw, small)
+            if self.mode == want:
+                self.ready_gen = max(self.ready_gen, gen)
+            self.frame_cond.notify_all()
+        now = time.time()
+        if self.frame_time:
+            gap = now - self.frame_time
+            self.period = gap if not self.period else self.period + 0.1 * (gap - self.period)
+        self.frame_time = now
+        return True
+
+    def on_frame(self):
+        pass
+
+    def get_raw_frame(self):
+        return self.latest[1]
+
+    def frame_seq(self):
+        return self.latest[0]
+
+    def wait_frame(self, seq, timeout):
+        # wait for a frame newer than seq, returns (seq, raw_frame, small)
+        with self.frame_cond:
+            if not self.frame_cond.wait_for(lambda: self.seq != seq, timeout):
+                return None
+            return self.seq, self.raw_frame, self.small
+
+    def run(self):
+        print('Start cam thread')
+        while not self.stop:
+            if self.capture():
+                if self.on_frame() is False:
+                    break
+            else:
+                time.sleep(0.01) # no frame, don't spin on a dead camera
+            if self.interval:
+                time.sleep(self.interval)
+        print('End cam thread')
+
+
+class PreviewThread(Thread):
+    # Hands the newest frame to render() at most fps times a second, and
+    # only while active, whatever rate the grabber runs at.
+    def __init__(self, grabber, render, fps=10.0):
+        super().__init__()
+        self.grabber = grabber
+        self.render = render
+        self.fps = fps
+        self.active = True
+        self.stop = False
+        self.start()
+
+    def run(self):
+        seq = 0
+        due = 0
+        while not self.stop and not self.grabber.stop:
+            if not self.active or self.fps <= 0:
+                time.sleep(0.1)
+                continue
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            res = self.grabber.wait_frame(seq, 0.5)
+            if res is None:
+                continue
+            seq, frame, _ = res
+            due = time.monotonic() + 1.0 / self.fps
+            if self.render(frame) is False:
+                break
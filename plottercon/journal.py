@@ -0,0 +1,88 @@
+from threading import Lock
+import json
+import os
+import time
+
+JOURNAL_NAME = 'scan_journal.jsonl'
+
+
+class ScanJournal(object):
+    # Append-only record of a scan, one JSON object per line. Every line is
+    # flushed and synced so a crash loses at most the tile being written.
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, JOURNAL_NAME)
+        self.lock = Lock()
+        self.f = None
+        self.tiles = set() # keys journaled since open()
+
+    def open(self, params, origin, resume=False):
+        self.f = open(self.path, 'a' if resume else 'w')
+        self.tiles = set()
+        if resume and self.f.tell() > 0:
+            self.f.write('\n') # terminate a torn line left by a crash
+        rec = 'resume' if resume else 'start'
+        self.write({'type': rec, 'params': params, 'origin': list(origin)})
+
+    def write(self, rec):
+        rec['time'] = round(time.time(), 3)
+        with self.lock:
+            if self.f is None: return
+            self.f.write(json.dumps(rec) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def tile(self, key, filename, pos):
+        self.write({'type': 'tile', 'tile': list(key),
+                    'file': os.path.relpath(filename, os.path.dirname(self.path)),
+                    'pos': list(pos)})
+        with self.lock:
+            self.tiles.add(tuple(key))
+
+    def focus(self, key, z):
+        self.write({'type': 'focus', 'tile': list(key), 'z': z})
+
+    def focus_map(self, data):
+        self.write({'type': 'focus_map', 'map': data})
+
+    def close(self, complete=False):
+        if complete:
+            self.write({'type': 'complete'})
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def load_journal(out_dir):
+    path = os.path.join(out_dir, JOURNAL_NAME)
+    if not os.path.isfile(path):
+        return None
+
+    res = {'params': None, 'origin': None, 'done': {}, 'focus': {}, 'focus_map': None, 'last': None, 'complete': False}
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip(): continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue # torn line from a crash
+            kind = rec.get('type')
+            if kind == 'start':
+                res['params'] = rec['params']
+                res['origin'] = rec['origin']
+            elif kind == 'tile':
+                key = tuple(rec['tile'])
+                res['done'][key] = rec
+                res['last'] = rec
+            elif kind == 'focus':
+                res['focus'][tuple(rec['tile'])] = rec['z']
+            elif kind == 'focus_map':
+                res['focus_map'] = rec['map']
+            elif kind == 'complete':
+                res['complete'] = True
+            elif kind == 'resume':
+                res['complete'] = False
+
+    if res['params'] is None:
+        return None
+    return res
@@ -0,0 +1,66 @@
+from threading import Lock
+import os
+import cv2
+import numpy as np
+
+MOSAIC_NAME = 'mosaic.npy'
+MOSAIC_MAX_MEM = 64 * 1024 * 1024 # bigger canvases live in a memmap file
+
+
+class MosaicCanvas(object):
+    # Downscaled overview of a scan. Each tile is shrunk to tile_px square
+    # and dropped into a preallocated canvas at its grid position, Y up.
+    # Changed areas are collected as dirty rects for the viewer to repaint.
+    def __init__(self, xsteps, ysteps, tile_px=64, out_dir=None, max_mem=MOSAIC_MAX_MEM):
+        self.xsteps = xsteps
+        self.ysteps = ysteps
+        self.tile_px = tile_px
+        self.shape = ((ysteps + 1) * tile_px, (xsteps + 1) * tile_px, 3)
+        self.lock = Lock()
+        self.dirty = []
+        self.path = None
+
+        size = self.shape[0] * self.shape[1] * self.shape[2]
+        if out_dir and size > max_mem:
+            self.path = os.path.join(out_dir, MOSAIC_NAME)
+            self.data = self.open_memmap(self.path)
+        else:
+            self.data = np.zeros(self.shape, np.uint8)
+
+    def open_memmap(self, path):
+        # a resumed scan keeps the tiles it already placed
+        if os.path.isfile(path):
+            try:
+                data = np.load(path, mmap_mode='r+')
+                if data.shape == self.shape and data.dtype == np.uint8:
+                    return data
+            except (OSError, ValueError):
+                pass
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=self.shape)
+
+    def tile_rect(self, iy, ix):
+        t = self.tile_px
+        return ix * t, (self.ysteps - iy) * t, t, t
+
+    def place(self, iy, ix, frame):
+        x, y, w, h = self.tile_rect(iy, ix)
+        small = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+        if small.ndim == 2:
+            small = cv2.cvtColor(small, cv2.COLOR_GRAY2BGR)
+        with self.lock:
+            self.data[y:y+h, x:x+w] = small
+            self.dirty.append((x, y, w, h))
+
+    def take_dirty(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, []
+        return dirty
+
+    def view(self, x, y, w, h):
+        with self.lock:
+            return self.data[y:y+h, x:x+w].copy()
+
+    def close(self):
+        with self.lock:
+            if isinstance(self.data, np.memmap):
+                self.data.flush()
@@ -0,0 +1,68 @@
+def serpentine(xsteps, ysteps):
+    # (iy, ix) tile indices, X direction alternates every row
+    for iy in range(ysteps + 1):
+        xs = range(xsteps + 1)
+        if iy % 2:
+            xs = reversed(xs)
+        for ix in xs:
+            yield iy, ix
+
+
+def scan_tiles(x0, y0, inc, xsteps, ysteps):
+    for iy, ix in serpentine(xsteps, ysteps):
+        yield iy, ix, x0 + (ix*inc), y0 + (iy*inc)
+
+
+ORDERS = ['z_major', 'xy_major']
+
+def scan_order(x0, y0, inc, xsteps, ysteps, z_range, order='z_major'):
+    # (zi, z, iy, ix, x, y) in capture order. z_major runs the XY serpentine
+    # once per level. xy_major visits each position once and captures every
+    # level there, alternating the Z direction so the next position starts
+    # on the level the last one finished on.
+    if order == 'xy_major':
+        levels = list(range(len(z_range)))
+        for n, (iy, ix, x, y) in enumerate(scan_tiles(x0, y0, inc, xsteps, ysteps)):
+            for zi in (levels if n % 2 == 0 else reversed(levels)):
+                yield zi, z_range[zi], iy, ix, x, y
+    else:
+        for zi, z in enumerate(z_range):
+            for iy, ix, x, y in scan_tiles(x0, y0, inc, xsteps, ysteps):
+                yield zi, z, iy, ix, x, y
+
+
+# Streamed scan: every tile is a move, a marker whose ok means the stage has
+# arrived and settled, then a dwell that holds the stage still while the host
+# grabs the frame. Tiles are queued ahead so the next move starts without a
+# host round trip.
+class ScanPlanner(object):
+    def __init__(self, control, speed, settle=0.0, hold=0.25, lookahead=2, z_speed=None):
+        self.control = control
+        self.speed = speed
+        self.z_speed = z_speed or control.jog_z_speed
+        self.settle = settle
+        self.hold = hold
+        self.lookahead = max(1, lookahead)
+
+    def tile_cmds(self, x, y, z=None):
+        # returns the lines and the position of the capture marker in them,
+        # z is only given when the tile is on a different level
+        if self.settle > 0:
+            marker = self.control.dwell_cmd(self.settle)
+        else:
+            marker = self.control.sync_cmd()
+        cmds = []
+        if z is not None:
+            cmds.append(self.control.move_cmd(z=z, speed=self.z_speed))
+        cmds += [
+            self.control.move_cmd(x=x, y=y, speed=self.speed),
+            marker,
+            self.control.dwell_cmd(self.hold),
+        ]
+        return cmds, len(cmds) - 2
+
+    def send_tile(self, x, y, z=None):
+        # queue one tile, returns the ack index of its capture marker
+        cmds, marker = self.tile_cmds(x, y, z)
+        last = self.control.Send(cmds)
+        return last - (len(cmds) - 1 - marker)
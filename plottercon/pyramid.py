@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import cv2
+import numpy as np
+
+DZI_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" Overlap="0" TileSize="{tile}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+
+def level_count(width, height):
+    return int(math.ceil(math.log2(max(width, height, 1)))) + 1
+
+def write_tile(path, tile, params):
+    # runs on the pool, imencode releases the GIL
+    ok, buf = cv2.imencode(os.path.splitext(path)[1], tile, params)
+    if not ok:
+        raise IOError(f'unable to encode {path}')
+    with open(path, 'wb') as f:
+        f.write(buf)
+
+
+class PyramidLevel(object):
+    # Buffers rows of one level, cuts every full band into tiles and hands a
+    # half size copy of the band to the level above it (lower resolution).
+    def __init__(self, pyramid, level, width, height):
+        self.pyramid = pyramid
+        self.level = level
+        self.width = width
+        self.height = height
+        self.row = 0
+        self.buf = []
+        self.buf_rows = 0
+        self.next = None
+        if level > 0:
+            self.next = PyramidLevel(pyramid, level - 1, (width + 1) // 2, (height + 1) // 2)
+        os.makedirs(os.path.join(pyramid.files_dir, str(level)), exist_ok=True)
+
+    def add_rows(self, rows):
+        self.buf.append(rows)
+        self.buf_rows += len(rows)
+        size = self.pyramid.tile_size
+        if self.buf_rows < size:
+            return
+        data = np.concatenate(self.buf) if len(self.buf) > 1 else self.buf[0]
+        n = (len(data) // size) * size
+        self.emit(data[:n])
+        rest = data[n:]
+        self.buf = [rest] if len(rest) else []
+        self.buf_rows = len(rest)
+
+    def emit(self, band):
+        size = self.pyramid.tile_size
+        for y in range(0, len(band), size):
+            rows = band[y:y + size]
+            for col, x in enumerate(range(0, self.width, size)):
+                self.pyramid.submit(self.level, col, self.row, rows[:, x:x + size])
+            self.row += 1
+        if self.next is not None:
+            h = (len(band) + 1) // 2
+            self.next.add_rows(cv2.resize(band, (self.next.width, h), interpolation=cv2.INTER_AREA))
+
+    def finish(self):
+        if self.buf_rows:
+            self.emit(np.concatenate(self.buf))
+            self.buf = []
+            self.buf_rows = 0
+        if self.next is not None:
+            self.next.finish()
+
+
+class DeepZoomWriter(object):
+    # Streams an image top to bottom into a DZI pyramid, name.dzi plus
+    # name_files/<level>/<col>_<row>.<fmt>. Tiles encode on a thread pool
+    # with a bounded backlog so memory stays flat.
+    def __init__(self, out_dir, name, width, height, tile_size=256, fmt='jpg', quality=90, workers=None):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality] if fmt == 'jpg' else []
+        self.dzi_path = os.path.join(out_dir, name + '.dzi')
+        self.files_dir = os.path.join(out_dir, name + '_files')
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.pending = []
+        self.tiles = 0
+        self.top = PyramidLevel(self, level_count(width, height) - 1, width, height)
+
+    def submit(self, level, col, row, tile):
+        path = os.path.join(self.files_dir, str(level), f'{col}_{row}.{self.fmt}')
+        self.pending.append(self.pool.submit(write_tile, path, np.ascontiguousarray(tile), self.params))
+        self.tiles += 1
+        while len(self.pending) > 4 * self.workers:
+            self.pending.pop(0).result()
+
+    def add_rows(self, rows):
+        self.top.add_rows(rows)
+
+    def close(self):
+        self.top.finish()
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.pool.shutdown()
+        with open(self.dzi_path, 'w') as f:
+            f.write(DZI_XML.format(fmt=self.fmt, tile=self.tile_size, width=self.width, height=self.height))
+
+
+def export_strips(strips, width, height, out_dir, name, progress=None, **kw):
+    # strips yields (y, rows) in order, as from stitch.iter_strips()
+    os.makedirs(out_dir, exist_ok=True)
+    writer = DeepZoomWriter(out_dir, name, width, height, **kw)
+    for y, rows in strips:
+        writer.add_rows(rows)
+        if progress:
+            progress(y + len(rows), height)
+    writer.close()
+    return writer
+
+def npy_strips(path, strip=512):
+    data = np.load(path, mmap_mode='r')
+    for y in range(0, data.shape[0], strip):
+        yield y, np.asarray(data[y:y + strip])
@@ -0,0 +1,636 @@
+from threading import Thread
+import time
+import errno
+import glob
+import os
+from . settle import wait_settled, SettleTracker
+from . planner import scan_order, ScanPlanner
+from . journal import ScanJournal
+from . timing import ScanTimer
+from . estimate import ScanEstimate
+from . mosaic import MosaicCanvas
+from . stack import IncrementalStacker, STACK_DIR
+from . tiles import parse_tile_name
+from . container import ContainerWriter, TileContainer, TILE_FORMATS
+from . average import FrameAverager, average_frames
+from . focus import AutoFocus
+from . focusmap import FocusMap, sample_grid
+from . control import Disconnected
+
+# how long a capture waits for a camera that hasn't delivered a frame yet
+FRAME_WAIT = 2.0
+
+# options that fix which tiles a scan takes, in what order and where, with
+# the value a scan journaled without them used. A resume always takes
+# these from the journal, everything else may be changed.
+LAYOUT_OPTS = {
+    'order': 'z_major',
+    'stack': False,
+    'autofocus': False,
+    'focus_map': 'off',
+    'focus_points': 3,
+    'container': False,
+    'tile_format': 'jpeg',
+}
+
+
+def resume_options(journaled, overrides):
+    # the journaled options with overrides applied, ValueError for any
+    # override that would change the scan's layout
+    conflicts = []
+    for key, value in overrides.items():
+        if key in LAYOUT_OPTS and value != journaled.get(key, LAYOUT_OPTS[key]):
+            conflicts.append(f'{key} (scan has {journaled.get(key, LAYOUT_OPTS[key])}, given {value})')
+    if conflicts:
+        raise ValueError('resuming would change ' + ', '.join(conflicts))
+    opts = dict(journaled)
+    opts.update(overrides)
+    return opts
+
+def check_storage(out_dir, container):
+    # ValueError if out_dir already has tiles stored the other way, a scan
+    # keeps all of its tiles in containers or all as files
+    for root in [out_dir] + glob.glob(os.path.join(out_dir, 'cam*')):
+        if container:
+            if any(parse_tile_name(p) for p in glob.glob(os.path.join(root, 'Z*', '*'))):
+                raise ValueError(f'{root} already has tiles as files, not in a container')
+        elif TileContainer.exists(root):
+            raise ValueError(f'{root} already has tiles in a container')
+
+class ScanRunner(Thread):
+    # Runs frame and capture commands on its own thread. Progress goes to
+    # the listener through notify(), which the GUI overrides to hop onto
+    # its main loop, so this has no GUI dependencies of its own.
+    #
+    # cameras holds extra grabbers by camera id, each tile is taken from
+    # all of them at once and saved under cam{id}/ in the scan directory.
+    def __init__(self, control, grabber, writer, listener=None, cameras=None):
+        super().__init__()
+        self.control = control
+        self.grabber = grabber
+        self.cameras = cameras or {}
+        self.writer = writer
+        self.listener = listener
+        self.stop = False
+        self.pause = False
+        self.running_cap = False
+        self.stop_cap = False
+        self.stop_cmd = False
+
+        self.xsteps = 0
+        self.ysteps = 0
+        self.inc = 0
+        self.z_levels = 0
+        self.z_step = 0
+        self.out_dir = None
+        self.origin = None
+        self.resume = None
+        self.journal = None
+        self.opts = {}
+
+        self.settle_mode = 'fixed'
+        self.settle_max = 1.0
+        self.settle_thresh = 1.5
+        self.settle = SettleTracker()
+        self.capture_cost = None
+
+        self.stream = False
+        self.stream_hold = 0.25
+        self.stream_lookahead = 2
+
+        self.order = 'z_major'
+
+        self.mosaic_tile = 0
+        self.mosaic = None
+
+        self.stack = False
+        self.stacker = None
+
+        # tiles in a chunked container instead of a file each
+        self.container = False
+        self.tile_format = 'jpeg'
+        self.jpeg_quality = 95
+        self.png_level = 1
+        self.sinks = {}
+
+        # frames averaged per tile, 1 is a single frame
+        self.average = 1
+        self.average_method = 'mean'
+        self.average_thresh = 2.0
+        self.averager = None
+
+        # per tile autofocus, the Z levels are centred on the focus found
+        self.autofocus = False
+        self.af_range = 1.0
+        self.af_steps = 7
+        self.af_tol = 0.01
+        self.focus_z = {}
+        self.last_focus = None
+
+        # focus map pre-scan, 'off' or a FocusMap method
+        self.focus_map = 'off'
+        self.focus_points = 3
+        self.fmap = None
+
+        # scan problems other than failed writes, (file, error) like the writer's
+        self.errors = []
+
+        self.cmd = None
+
+        self.start()
+
+    def cmd_frame(self):
+        self.cmd = None
+        speed = self.control.jog_speed
+        dwell_time = 1.5
+        dwell = f'G4 S{dwell_time}'
+        cmds = [
+            self.control.gcode_rel_header(),
+            self.control.move_cmd(x=self.xsteps*self.inc, speed=speed),
+            dwell,
+            self.control.move_cmd(y=self.ysteps*self.inc, speed=speed),
+            dwell,
+            self.control.move_cmd(x=self.xsteps*self.inc*-1, speed=speed),
+            dwell,
+            self.control.move_cmd(y=self.ysteps*self.inc*-1, speed=speed),
+            'G90',
+        ]
+        self.control.Send(cmds)
+
+    def do_frame(self, x, y, inc):
+        self.xsteps = x
+        self.ysteps = y
+        self.inc = inc
+        self.cmd = self.cmd_frame
+
+    def cmd_run_capture(self):
+        self.cmd = None
+        self.pause = False
+        self.stop_cap = False
+        self.running_cap = True
+        self.writer.reset_stats()
+        if self.resume:
+            _x, _y, _z = self.resume['origin'][:3]
+            self.done = self.resume['done']
+            self.focus_z = dict(self.resume.get('focus', {}))
+            fmap = self.resume.get('focus_map')
+            self.fmap = FocusMap.from_dict(fmap) if fmap else None
+        else:
+            _x, _y, _z = self.control.Position()[:3]
+            self.done = {}
+            self.focus_z = {}
+            self.fmap = None
+        self.last_focus = _z
+        speed = self.control.jog_speed
+        self.count = 0
+        self.last = self.control.Position()[:3]
+
+        params = {
+            'xsteps': self.xsteps,
+            'ysteps': self.ysteps,
+            'inc': self.inc,
+            'z_levels': self.z_levels,
+            'z_step': self.z_step,
+            'opts': self.opts,
+            'cameras': sorted(self.cameras),
+        }
+        self.journal = ScanJournal(self.out_dir)
+        self.journal.open(params, (_x, _y, _z), resume=self.resume is not None)
+        self.timer = ScanTimer(self.out_dir, self.total_tiles(), estimate=self.estimate())
+        if self.mosaic_tile:
+            self.mosaic = MosaicCanvas(self.xsteps, self.ysteps, self.mosaic_tile, self.out_dir)
+            self.notify('on_mosaic_start', self.mosaic)
+        self.averager = None
+        if self.average > 1:
+            self.averager = FrameAverager(self.average, self.average_method, self.average_thresh)
+        self.stacker = None
+        if self.stack and self.z_levels > 1:
+            self.stacker = self.start_stacker()
+
+        self.sinks = {}
+        if self.container:
+            # one container per camera directory
+            for cam_id in [None] + list(self.cameras):
+                root = self.out_dir if cam_id is None else self.camera_dir(cam_id)
+                self.sinks[cam_id] = ContainerWriter(root, self.tile_format, self.jpeg_quality, self.png_level)
+
+        # full resolution stills for the whole scan
+        if self.grabber is not None and not self.grabber.set_mode('still'):
+            print('Camera did not switch to still mode')
+        for cam_id, grabber in self.cameras.items():
+            if not grabber.set_mode('still'):
+                print(f'Camera {cam_id} did not switch to still mode')
+
+        self.control.Send(self.control.gcode_abs_header())
+        z_range = [_z + (i*self.z_step) for i in range(self.z_levels)]
+        # a container keeps the Z levels in its index, no directories needed
+        for z in ([] if self.sinks else z_range):
+            for cam_dir in [self.out_dir] + [self.camera_dir(c) for c in self.cameras]:
+                out_dir = os.path.join(cam_dir, f'Z{z}')
+                try:
+                    os.makedirs(out_dir)
+                except OSError as ex:
+                    if ex.errno == errno.EEXIST and os.path.isdir(out_dir):
+                        pass
+
+        self.errors = []
+        try:
+            if self.focus_map != 'off' and self.fmap is None:
+                self.fmap = self.prescan_focus(_x, _y, speed)
+                if self.fmap is not None:
+                    self.journal.focus_map(self.fmap.to_dict())
+            tiles = self.pending_tiles(_x, _y, z_range)
+            if self.stream and self.autofocus:
+                print('Autofocus needs the stage under control, not streaming moves')
+            if self.stream and not self.autofocus:
+                complete = self.run_tiles_streamed(tiles, speed)
+            else:
+                complete = self.run_tiles(tiles, speed)
+        except Disconnected as ex:
+            print(f'Scan aborted: {ex}')
+            self.errors.append((self.out_dir, str(ex)))
+            complete = False
+
+        if self.control.Connected():
+            self.control.Send(self.control.move_cmd(x=_x, y=_y, speed=speed))
+            self.control.Send(self.control.move_cmd(z=_z, speed=self.control.jog_z_speed))
+        errors = self.writer.flush() + self.errors
+        if self.grabber is not None:
+            self.grabber.set_mode('preview', timeout=0)
+        for grabber in self.cameras.values():
+            grabber.set_mode('preview', timeout=0)
+        for sink in self.sinks.values():
+            sink.close()
+        self.sinks = {}
+        if self.stacker is not None:
+            errors += self.stacker.close()
+        # complete only if every tile made it to the journal, not just tried
+        missing = self.total_tiles() - len(set(self.done) | self.journal.tiles)
+        if complete and missing:
+            print(f'{missing} tiles were not captured')
+            complete = False
+        self.journal.close(complete and not errors)
+        self.timer.close()
+        if self.mosaic is not None:
+            self.mosaic.close()
+        if not self.stream and self.timer.capture_cost() is not None:
+            self.capture_cost = self.timer.capture_cost()
+        self.resume = None
+        self.running_cap = False
+        self.notify('on_scan_complete', complete, errors)
+
+    def notify(self, name, *args):
+        cb = getattr(self.listener, name, None)
+        if cb is not None:
+            cb(*args)
+
+    def camera_dir(self, cam_id):
+        return os.path.join(self.out_dir, f'cam{cam_id}')
+
+    def take_picture(self, directory, name, saved=None, grabber=None, sink=None, frame=None):
+        grabber = grabber or self.grabber
+        if frame is None:
+            frame = grabber.get_raw_frame()
+        if frame is None:
+            # nothing grabbed yet, give the camera time for its next frame
+            res = grabber.wait_frame(grabber.frame_seq(), FRAME_WAIT)
+            frame = res[1] if res else None
+        #get the directory to save it in.
+        filename = os.path.join(directory, name + (sink.ext if sink else '.jpeg'))
+        if frame is None:
+            print(f'No frame for {filename}')
+            self.errors.append((filename, 'no frame from the camera'))
+            return False
+        #queue the image, encoding and writing happen on the writer threads
+        callback = (lambda copy, timing: saved(filename, copy, timing)) if saved else None
+        return self.writer.submit(filename, frame, callback, sink)
+
+    def stopped(self):
+        return self.stop or self.stop_cap
+
+    def wait_pause(self):
+        while self.pause and not self.stopped():
+            time.sleep(0.1)
+
+    def estimate(self):
+        opts = dict(self.opts)
+        if self.capture_cost is not None:
+            opts['capture_cost'] = self.capture_cost
+        return ScanEstimate(self.xsteps, self.ysteps, self.inc, self.z_levels, self.z_step,
+                            self.control.jog_speed, self.control.jog_z_speed, opts,
+                            self.settle, self.control.arrive_poll)
+
+    def start_stacker(self):
+        stacker = IncrementalStacker(os.path.join(self.out_dir, STACK_DIR), self.z_levels)
+        # positions whose other levels were saved before a resume
+        for (zi, iy, ix), rec in self.done.items():
+            filename = os.path.join(self.out_dir, rec['file'])
+            tile = parse_tile_name(filename)
+            if tile is not None:
+                stacker.add((iy, ix), zi, filename, tile.name)
+        return stacker
+
+    def total_tiles(self):
+        return (self.xsteps + 1) * (self.ysteps + 1) * self.z_levels
+
+    def progress(self):
+        self.notify('on_scan_progress', self.count, self.timer.stats(self.count))
+
+    def next_tile(self):
+        self.count += 1
+        self.progress()
+
+    def pending_tiles(self, x0, y0, z_range):
+        # tiles still to capture in scan order, counting the finished ones
+        tiles = []
+        for tile in scan_order(x0, y0, self.inc, self.xsteps, self.ysteps, z_range, self.order):
+            zi, z, iy, ix, x, y = tile
+            if (zi, iy, ix) in self.done:
+                self.count += 1
+            else:
+                tiles.append(tile)
+        self.progress()
+        return tiles
+
+    def capture_tile(self, zi, z, iy, ix, x, y, stamps, frame=None, at_z=None):
+        out_dir = os.path.join(self.out_dir, f'Z{z}')
+        name = f'Z{z}Y{y}X{x}'
+        pos = self.control.Position()
+        journal = self.journal
+        timer = self.timer
+        mosaic = self.mosaic
+        stacker = self.stacker
+        def saved(filename, frame, timing):
+            journal.tile((zi, iy, ix), filename, pos)
+            stamps.update(timing)
+            timer.tile_done((zi, iy, ix), stamps)
+            if mosaic is not None:
+                mosaic.place(iy, ix, frame)
+                self.notify('on_mosaic_update')
+            if stacker is not None:
+                stacker.add((iy, ix), zi, filename, f'Y{y}X{x}')
+        stamps['grab'] = time.time()
+        self.notify('on_scan_capture', (x, y, z if at_z is None else at_z))
+        if self.take_picture(out_dir, name, saved, sink=self.sinks.get(None), frame=frame):
+            timer.grabbed(stamps)
+        # the other cameras' latest frames, their writes queue alongside. A
+        # missing one is an error like the main camera's, see take_picture()
+        for cam_id, grabber in self.cameras.items():
+            self.take_picture(os.path.join(self.camera_dir(cam_id), f'Z{z}'), name,
+                              grabber=grabber, sink=self.sinks.get(cam_id))
+        self.last = (x, y, z if at_z is None else at_z)
+
+    def autofocuser(self):
+        return AutoFocus(self.control, self.grabber, stopped=self.stopped)
+
+    def focus_at(self, x, y, speed, center=None):
+        # sharpest Z at x, y, searched around center or the last focus found
+        self.control.Send(self.control.move_cmd(x=x, y=y, speed=speed))
+        while not self.control.WaitForArrival(x=x, y=y, timeout=1.0):
+            if self.stopped(): return None
+        center = self.last_focus if center is None else center
+        z, score = self.autofocuser().search(center, self.af_range, self.af_steps, self.af_tol)
+        self.last = tuple(self.control.Position()[:3]) # send_moves() starts from here
+        if z is None or score <= 0:
+            return None
+        self.last_focus = z
+        return z
+
+    def prescan_focus(self, x0, y0, speed):
+        # autofocus on a sparse grid over the scan area and fit the surface
+        points = []
+        for x, y in sample_grid(x0, y0, self.xsteps * self.inc, self.ysteps * self.inc, self.focus_points):
+            z = self.focus_at(x, y, speed)
+            if self.stopped(): return None
+            if z is not None:
+                points.append((x, y, z))
+        if not points:
+            print('Focus map pre-scan found no focus')
+            return None
+        fmap = FocusMap(points, self.focus_map)
+        print(f'Focus map ({fmap.method}) from {len(points)} points, '
+              f'max residual {max(abs(r) for r in fmap.residuals()):.4f} mm')
+        return fmap
+
+    def tile_z(self, zi, z, iy, ix, x, y, speed):
+        # the height to capture a tile's level at: the nominal z, or the
+        # levels centred on the tile's focus. The focus comes from the focus
+        # map, refined by autofocus if that's on too (found on the first
+        # visit and kept for the other levels).
+        if not self.autofocus and self.fmap is None:
+            return z
+        focus = self.focus_z.get((iy, ix))
+        if focus is None and self.autofocus:
+            center = self.fmap.predict(x, y) if self.fmap is not None else None
+            focus = self.focus_at(x, y, speed, center)
+            if focus is not None:
+                self.focus_z[(iy, ix)] = focus
+                self.journal.focus((iy, ix), focus)
+        if focus is None and self.fmap is not None:
+            focus = self.fmap.predict(x, y)
+        if focus is None:
+            return z
+        return round(focus + (zi - (self.z_levels - 1) / 2) * self.z_step, 4)
+
+    def send_moves(self, x, y, z, speed):
+        # Z and XY are separate moves so each runs at its own feed rate
+        if z != self.last[2]:
+            self.control.Send(self.control.move_cmd(z=z, speed=self.control.jog_z_speed))
+        if (x, y) != tuple(self.last[:2]):
+            self.control.Send(self.control.move_cmd(x=x, y=y, speed=speed))
+
+    def run_tiles(self, tiles, speed):
+        for zi, z, iy, ix, x, y in tiles:
+            self.next_tile()
+            if self.stopped(): return False
+            self.wait_pause()
+            stamps = {'move': time.time()}
+            at_z = self.tile_z(zi, z, iy, ix, x, y, speed)
+            if self.stopped(): return False
+            self.send_moves(x, y, at_z, speed)
+            while not self.control.WaitForArrival(x=x, y=y, z=at_z, timeout=1.0):
+                if self.stopped(): return False
+            stamps['arrive'] = time.time()
+            lx, ly, lz = self.last
+            dist = abs(x - lx) + abs(y - ly) + abs(at_z - lz)
+            if self.averager is not None:
+                frame = self.settle_averaged(dist, stamps)
+            else:
+                self.wait_settle(dist)
+                stamps['settle'] = time.time()
+                frame = None
+            self.capture_tile(zi, z, iy, ix, x, y, stamps, frame, at_z)
+        return True
+
+    def run_tiles_streamed(self, tiles, speed):
+        # keep the firmware queue primed, the ok for each tile's marker
+        # means the stage is settled and held for the capture
+        planner = ScanPlanner(self.control, speed, settle=self.settle_max,
+                              hold=self.stream_hold, lookahead=self.stream_lookahead)
+        tiles = iter(tiles)
+        pending = []
+        done = False
+        sent_z = self.last[2]
+        while True:
+            while not done and not self.stopped() and not self.pause and len(pending) < planner.lookahead:
+                tile = next(tiles, None)
+                if tile is None:
+                    done = True
+                    break
+                zi, z, iy, ix, x, y = tile
+                at_z = self.tile_z(zi, z, iy, ix, x, y, speed) # no autofocus when streaming
+                stamps = {'move': time.time()}
+                pending.append((tile, at_z, planner.send_tile(x, y, at_z if at_z != sent_z else None), stamps))
+                sent_z = at_z
+
+            if not pending:
+                if done: return True
+                if self.stopped(): return False
+                self.wait_pause()
+                continue
+
+            (zi, z, iy, ix, x, y), at_z, ack, stamps = pending.pop(0)
+            self.next_tile()
+            while not self.control.WaitForAck(ack, timeout=1.0):
+                if not self.control.Connected():
+                    raise Disconnected('controller disconnected')
+            # the marker is acknowledged after the firmware's settle dwell
+            stamps['arrive'] = stamps['settle'] = time.time()
+            frame = None
+            if self.averager is not None:
+                # as many frames as fit in the hold
+                frame = average_frames(self.grabber, self.averager, timeout=planner.hold)
+            else:
+                self.wait_frames(planner.hold)
+            self.capture_tile(zi, z, iy, ix, x, y, stamps, frame, at_z)
+
+    def wait_frames(self, timeout):
+        # a frame taken after now from every camera, the waits overlap
+        grabbers = [self.grabber] + list(self.cameras.values())
+        seqs = [g.frame_seq() for g in grabbers]
+        deadline = time.time() + timeout
+        for grabber, seq in zip(grabbers, seqs):
+            grabber.wait_frame(seq, max(0.0, deadline - time.time()))
+
+    def settle_averaged(self, dist, stamps):
+        # settle and average in one go. Frames are taken from the tail of
+        # the settle window, ones still moving restart or are rejected by
+        # the averager, so a settled tile costs about one frame more than
+        # a single capture rather than N.
+        start = stamps['arrive']
+        period = self.grabber.period or 0.05
+        if self.settle_mode == 'adaptive':
+            start += self.settle.predict(dist, 0) * 0.5
+        else:
+            start += max(0.0, self.settle_max - (self.average - 1) * period)
+        # enough time for the settle plus every frame twice over
+        timeout = self.settle_max + 2 * self.average * period
+        frame = average_frames(self.grabber, self.averager, start, timeout, self.stopped)
+        settled = self.averager.run_start or time.time()
+        stamps['settle'] = settled
+        if self.settle_mode == 'adaptive':
+            self.settle.record(dist, settled - stamps['arrive'])
+        return frame
+
+    def wait_settle(self, dist):
+        if self.settle_mode != 'adaptive' or self.grabber is None:
+            time.sleep(self.settle_max) # hold to settle motion
+            return
+        # frames are only compared once most of the expected settle time is over
+        predict = self.settle.predict(dist, 0)
+        secs = wait_settled(self.grabber, self.settle_thresh,
+                            self.settle_max, min_wait=predict*0.5)
+        self.settle.record(dist, secs)
+
+    def set_options(self, opts):
+        self.opts = dict(opts)
+        self.settle_mode = opts.get('settle_mode', self.settle_mode)
+        self.settle_max = opts.get('settle_max', self.settle_max)
+        self.settle_thresh = opts.get('settle_thresh', self.settle_thresh)
+        self.stream = opts.get('stream', self.stream)
+        self.stream_hold = opts.get('stream_hold', self.stream_hold)
+        self.stream_lookahead = opts.get('stream_lookahead', self.stream_lookahead)
+        self.mosaic_tile = opts.get('mosaic_tile', self.mosaic_tile)
+        self.stack = opts.get('stack', self.stack)
+        self.order = opts.get('order', self.order)
+        self.container = opts.get('container', self.container)
+        self.tile_format = opts.get('tile_format', self.tile_format)
+        if self.tile_format not in TILE_FORMATS:
+            self.tile_format = 'jpeg'
+        self.jpeg_quality = opts.get('jpeg_quality', self.jpeg_quality)
+        self.png_level = opts.get('png_level', self.png_level)
+        self.average = opts.get('average', self.average)
+        self.average_method = opts.get('average_method', self.average_method)
+        self.average_thresh = opts.get('average_thresh', self.average_thresh)
+        self.autofocus = opts.get('autofocus', self.autofocus)
+        self.af_range = opts.get('af_range', self.af_range)
+        self.af_steps = opts.get('af_steps', self.af_steps)
+        self.af_tol = opts.get('af_tol', self.af_tol)
+        self.focus_map = opts.get('focus_map', self.focus_map)
+        self.focus_points = opts.get('focus_points', self.focus_points)
+
+    def cmd_autofocus(self):
+        self.cmd = None
+        self.stop_cap = False
+        z0 = self.control.Position()[2]
+        try:
+            z, score = self.autofocuser().search(z0, self.af_range, self.af_steps, self.af_tol)
+        except Disconnected as ex:
+            print(f'Autofocus aborted: {ex}')
+            self.notify('on_autofocus_complete', z0, 0.0)
+            return
+        if z is None or score <= 0:
+            z = z0 # nothing to focus on, go back
+        self.control.Send(self.control.move_cmd(z=z, speed=self.control.jog_z_speed))
+        self.notify('on_autofocus_complete', z, score)
+
+    def do_autofocus(self, opts=None):
+        # focus at the current XY, from the UI
+        self.set_options(opts or {})
+        self.cmd = self.cmd_autofocus
+
+    def do_run_capture(self, xsteps, ysteps, inc, z_levels, z_step, out_dir, opts=None):
+        check_storage(out_dir, (opts or {}).get('container', self.container))
+        self.set_options(opts or {})
+        self.xsteps = xsteps
+        self.ysteps = ysteps
+        self.inc = inc
+        self.z_levels = z_levels
+        self.z_step = z_step
+        self.out_dir = out_dir
+        self.resume = None
+        self.cmd = self.cmd_run_capture
+
+    def do_resume_capture(self, out_dir, journal, opts=None):
+        # opts override the journaled options, see resume_options()
+        params = journal['params']
+        opts = resume_options(params.get('opts', {}), opts or {})
+        check_storage(out_dir, opts.get('container', LAYOUT_OPTS['container']))
+        self.set_options(opts)
+        self.xsteps = params['xsteps']
+        self.ysteps = params['ysteps']
+        self.inc = params['inc']
+        self.z_levels = params['z_levels']
+        self.z_step = params['z_step']
+        self.out_dir = out_dir
+        self.resume = journal
+        self.cmd = self.cmd_run_capture
+
+    def run(self):
+        try:
+            while not self.stop:
+                if self.cmd:
+                    self.cmd()
+                else:
+                    time.sleep(0.05)
+        except Exception as ex:
+            self.errors.append((self.out_dir, f'scan failed: {ex!r}'))
+            raise
+        finally:
+            # a capture that died part way still has to report, or whoever
+            # waits on on_scan_complete waits forever
+            if self.running_cap:
+                self.running_cap = False
+                if self.journal is not None:
+                    self.journal.close()
+                self.notify('on_scan_complete', False, list(self.errors))
@@ -0,0 +1,68 @@
+import time
+import cv2
+
+SETTLE_SIZE = (64, 64)
+
+def small_frame(frame, gray=None, dst=None):
+    # gray and dst are optional preallocated outputs
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+    return cv2.resize(gray, SETTLE_SIZE, dst=dst, interpolation=cv2.INTER_AREA)
+
+def frame_motion(a, b):
+    # mean absolute difference in grey levels between two small frames
+    return float(cv2.absdiff(a, b).mean())
+
+def wait_settled(grabber, threshold, max_wait, stable_frames=2, min_wait=0):
+    start = time.time()
+    end = start + max_wait
+    if min_wait > 0:
+        time.sleep(min(min_wait, max_wait))
+    seq = grabber.frame_seq()
+    prev = None
+    stable = 0
+    while True:
+        remain = end - time.time()
+        if remain <= 0: break
+        res = grabber.wait_frame(seq, remain)
+        if res is None: break
+        seq, _, small = res
+        if prev is not None:
+            if frame_motion(prev, small) < threshold:
+                stable += 1
+                if stable >= stable_frames: break
+            else:
+                stable = 0
+        prev = small.copy() # the grabber reuses its buffers
+    return time.time() - start
+
+
+class SettleTracker(object):
+    def __init__(self, data=None, alpha=0.3, res=0.5):
+        self.alpha = alpha
+        self.res = res
+        self.times = {}
+        if data:
+            for k, v in data.items():
+                self.times[float(k)] = float(v)
+
+    def bucket(self, dist):
+        return round(round(dist / self.res) * self.res, 3)
+
+    def record(self, dist, secs):
+        key = self.bucket(dist)
+        if key in self.times:
+            self.times[key] += self.alpha * (secs - self.times[key])
+        else:
+            self.times[key] = secs
+
+    def predict(self, dist, default=None):
+        if not self.times:
+            return default
+        key = self.bucket(dist)
+        if key in self.times:
+            return self.times[key]
+        near = min(self.times, key=lambda k: abs(k - key))
+        return self.times[near]
+
+    def to_dict(self):
+        return {str(k): round(v, 3) for k, v in self.times.items()}
@@ -0,0 +1,359 @@
+import math
+import re
+import socket
+import time
+from collections import deque
+from queue import Queue
+from threading import Thread, Lock
+import cv2
+import numpy as np
+from . estimate import move_time, move_distance
+
+WORD_RE = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+AXES = 'XYZ'
+
+
+class Segment(object):
+    def __init__(self, t0, start, end, speed, accel):
+        self.start = start
+        self.end = end
+        delta = [e - s for s, e in zip(start, end)]
+        self.dist = math.sqrt(sum(d*d for d in delta))
+        self.unit = [d / self.dist for d in delta] if self.dist > 0 else [0.0, 0.0, 0.0]
+        self.speed = speed
+        self.accel = accel
+        self.t0 = t0
+        self.t1 = t0 + move_time(self.dist, speed, accel)
+
+    def position(self, t):
+        s = move_distance(t - self.t0, self.dist, self.speed, self.accel)
+        return [p + u*s for p, u in zip(self.start, self.unit)]
+
+
+class SimMachine(object):
+    # Motion model of a Smoothie or GRBL style controller. Times are machine
+    # seconds, time_scale > 1 runs the machine faster than the wall clock.
+    def __init__(self, flavor='smoothie', accel=500.0, planner_size=16, time_scale=1.0,
+                 ring_amp=0.02, ring_freq=12.0, ring_tau=0.08):
+        self.flavor = flavor
+        self.accel = accel
+        self.planner_size = planner_size
+        self.time_scale = time_scale
+        self.ring_amp = ring_amp
+        self.ring_freq = ring_freq
+        self.ring_tau = ring_tau
+
+        self.lock = Lock()
+        self.t_start = time.monotonic()
+        self.segments = deque()
+        self.rest = ([0.0, 0.0, 0.0], -1e9, [0.0, 0.0, 0.0])
+        self.end_pos = [0.0, 0.0, 0.0]
+        self.busy_until = 0.0
+        self.feed = 1000.0 # mm/min
+        self.relative = False
+        self.motion = 0
+        self.lines = 0
+
+    def now(self):
+        return (time.monotonic() - self.t_start) * self.time_scale
+
+    def sleep(self, secs):
+        if secs > 0:
+            time.sleep(secs / self.time_scale)
+
+    def sync(self):
+        self.sleep(self.busy_until - self.now())
+
+    def position(self, physical=False, t=None):
+        # commanded position and state, with physical=True the stage
+        # also rings for a short while after every stop
+        if t is None: t = self.now()
+        with self.lock:
+            self.retire(t)
+            if self.segments and self.segments[0].t0 <= t:
+                return self.segments[0].position(t), 'Run'
+            pos, t_end, unit = self.rest
+            state = 'Run' if self.segments else 'Idle'
+            if not physical:
+                return list(pos), state
+            dt = t - t_end
+            ring = self.ring_amp * math.exp(-dt / self.ring_tau) * math.sin(2 * math.pi * self.ring_freq * dt)
+            return [p + u*ring for p, u in zip(pos, unit)], state
+
+    def retire(self, t):
+        # drop the segments finished by t, lock held
+        while self.segments and self.segments[0].t1 <= t:
+            seg = self.segments.popleft()
+            self.rest = (seg.end, seg.t1, seg.unit)
+
+    def velocity(self):
+        t = self.now()
+        dt = 0.002
+        a, _ = self.position(True, t - dt)
+        b, _ = self.position(True, t)
+        return [(q - p) / dt for p, q in zip(a, b)]
+
+    def status(self):
+        pos, state = self.position()
+        p = ','.join(f'{v:.4f}' for v in pos)
+        if self.flavor == 'grbl':
+            return f'<{state}|MPos:{p}|FS:{self.feed:.0f},0>'
+        return f'<{state}|MPos:{p}|WPos:{p}|F:{self.feed:.1f}>'
+
+    def plan_move(self, target, speed):
+        # blocks while the planner queue is full, as the firmware would
+        while True:
+            with self.lock:
+                self.retire(self.now())
+                if len(self.segments) < self.planner_size:
+                    seg = Segment(max(self.now(), self.busy_until), self.end_pos, target, speed, self.accel)
+                    self.segments.append(seg)
+                    self.busy_until = seg.t1
+                    self.end_pos = list(target)
+                    return
+            self.sleep(0.005)
+
+    def dwell(self, words):
+        self.sync()
+        if 'P' in words:
+            secs = words['P'] if self.flavor == 'grbl' else words['P'] / 1000.0
+        else:
+            secs = words.get('S', 0)
+        self.sleep(secs)
+
+    def home(self, axes):
+        self.sync()
+        target = list(self.end_pos)
+        for a in axes or AXES:
+            target[AXES.index(a)] = 0.0
+        self.plan_move(target, 50.0)
+        self.sync()
+
+    def execute(self, line):
+        # run one line, returns the reply once the firmware would send it
+        self.lines += 1
+        line = line.split(';')[0].strip().upper()
+        if not line:
+            return 'ok'
+        if line.startswith('$H'):
+            self.home('XY')
+            return 'ok'
+        if line.startswith('$'):
+            return 'ok'
+
+        gs = []
+        ms = []
+        words = {}
+        for k, v in WORD_RE.findall(line):
+            v = float(v)
+            if k == 'G': gs.append(v)
+            elif k == 'M': ms.append(v)
+            else: words[k] = v
+        if not gs and not ms and not words and self.flavor == 'grbl':
+            return 'error:1' # expected command letter
+
+        if 'F' in words:
+            self.feed = words['F']
+        for g in gs:
+            if g == 90: self.relative = False
+            elif g == 91: self.relative = True
+            elif g in (0, 1): self.motion = int(g)
+
+        if 28.2 in gs or 28 in gs:
+            self.home(''.join(a for a in AXES if a in line[line.index('G28'):]))
+        elif 4 in gs:
+            self.dwell(words)
+        elif 400 in ms:
+            self.sync()
+        elif any(a in words for a in AXES):
+            target = list(self.end_pos)
+            for i, a in enumerate(AXES):
+                if a in words:
+                    target[i] = target[i] + words[a] if self.relative else words[a]
+            self.plan_move(target, self.feed / 60.0)
+        return 'ok'
+
+
+class SimServer(Thread):
+    # Serves a SimMachine on a local TCP port. printcore (and so Control)
+    # connects to 'host:port' the same way it opens a serial device.
+    def __init__(self, machine=None, host='127.0.0.1', port=0, rx_size=None):
+        super().__init__(daemon=True)
+        self.machine = machine or SimMachine()
+        self.rx_size = rx_size
+        self.rx_overflows = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+        self.sock.settimeout(0.2)
+        self.address = '{}:{}'.format(*self.sock.getsockname())
+        self.stop = False
+        self.start()
+
+    def run(self):
+        while not self.stop:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.serve(conn)
+        self.sock.close()
+
+    def serve(self, conn):
+        wlock = Lock()
+        lines = Queue()
+        pending = [0]
+
+        def send(text):
+            with wlock:
+                try:
+                    conn.sendall((text + '\n').encode('ascii'))
+                except OSError:
+                    pass
+
+        def executor():
+            while True:
+                line = lines.get()
+                if line is None: break
+                reply = self.machine.execute(line)
+                with wlock:
+                    pending[0] -= len(line) + 1
+                send(reply)
+
+        worker = Thread(target=executor, daemon=True)
+        worker.start()
+        send('Grbl 1.1f [\'$\' for help]' if self.machine.flavor == 'grbl' else 'Smoothie')
+
+        buf = b''
+        conn.settimeout(0.2)
+        while not self.stop:
+            try:
+                data = conn.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data: break
+            # '?' is a realtime command, answered straight away
+            if b'?' in data:
+                for _ in range(data.count(b'?')):
+                    send(self.machine.status())
+                data = data.replace(b'?', b'')
+            buf += data.replace(b'\r', b'')
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                line = line.decode('ascii', 'replace').strip()
+                if not line and self.machine.flavor != 'grbl':
+                    continue # GRBL answers an empty line with ok
+                with wlock:
+                    pending[0] += len(line) + 1
+                    if self.rx_size and pending[0] > self.rx_size:
+                        self.rx_overflows += 1
+                lines.put(line)
+
+        lines.put(None)
+        worker.join()
+        conn.close()
+
+
+class SimCamera(object):
+    # Stand-in for cv2.VideoCapture that renders a synthetic sample at the
+    # simulated stage position, blurred while moving and with sensor noise.
+    # focus is the sample surface as (z0, dz/dx, dz/dy), away from it the
+    # image blurs by defocus px per mm. None keeps everything sharp.
+    def __init__(self, machine, width=1280, height=720, px_per_mm=200.0, fps=30.0,
+                 exposure=1/60.0, noise=2.0, seed=1234, tex_size=2048, focus=None, defocus=40.0):
+        self.machine = machine
+        self.focus = focus
+        self.defocus = defocus
+        self.max_width = width
+        self.max_height = height
+        self.width = width
+        self.height = height
+        self.px_per_mm = px_per_mm
+        self.fps = fps
+        self.exposure = exposure
+        self.opened = True
+        self.last_read = 0.0
+        self.frame_index = 0
+
+        rng = np.random.default_rng(seed)
+        tex = np.zeros((tex_size, tex_size, 3), np.float32)
+        for octave in (8, 32, 128, 512):
+            layer = rng.random((octave, octave, 3), dtype=np.float32)
+            layer = cv2.resize(layer, (tex_size, tex_size), interpolation=cv2.INTER_CUBIC)
+            tex += layer * (64.0 / math.sqrt(octave))
+        tex -= tex.min()
+        tex *= 255.0 / tex.max()
+        self.texture = tex.astype(np.uint8)
+        self.noise = [rng.normal(0, noise, (height, width, 3)).astype(np.int16) for _ in range(4)] if noise > 0 else None
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return float(self.height)
+        if prop == cv2.CAP_PROP_FPS: return float(self.fps)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(min(value, self.max_width))
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(min(value, self.max_height))
+        else:
+            return False
+        return True
+
+    def render(self, pos):
+        h, w = self.height, self.width
+        size = self.texture.shape[0]
+        # stage +X/+Y moves the sample the other way under the camera
+        cx = int(round(pos[0] * self.px_per_mm))
+        cy = int(round(pos[1] * self.px_per_mm))
+        ys = (np.arange(h) + cy - h // 2) % size
+        xs = (np.arange(w) + cx - w // 2) % size
+        return self.texture[ys[:, None], xs[None, :]]
+
+    def read(self, image=None):
+        if not self.opened:
+            return False, None
+        # pace frames like a real camera
+        interval = 1.0 / self.fps / self.machine.time_scale
+        wait = self.last_read + interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_read = time.monotonic()
+
+        pos, _ = self.machine.position(physical=True)
+        frame = self.render(pos)
+
+        if self.focus is not None:
+            z0, dzdx, dzdy = self.focus
+            sigma = min(30.0, abs(pos[2] - (z0 + dzdx * pos[0] + dzdy * pos[1])) * self.defocus)
+            if sigma > 0.3:
+                frame = cv2.GaussianBlur(frame, (0, 0), sigma)
+
+        vx, vy, _ = self.machine.velocity()
+        blur_x = int(abs(vx) * self.exposure * self.px_per_mm)
+        blur_y = int(abs(vy) * self.exposure * self.px_per_mm)
+        if blur_x > 1 or blur_y > 1:
+            frame = cv2.blur(frame, (max(1, blur_x), max(1, blur_y)))
+
+        if self.noise is not None and self.noise[0].shape[:2] == frame.shape[:2]:
+            noise = self.noise[self.frame_index % len(self.noise)]
+            frame = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        self.frame_index += 1
+
+        if image is not None and image.shape == frame.shape:
+            image[...] = frame
+            return True, image
+        return True, frame
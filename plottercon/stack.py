@@ -0,0 +1,119 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+import os
+import cv2
+import numpy as np
+from . tiles import TileSet
+from . container import read_image
+
+STACK_DIR = 'stacked'
+
+
+def sharpness(gray, blur=5):
+    # Laplacian energy, smoothed so the weights don't flip pixel to pixel
+    lap = cv2.Laplacian(gray, cv2.CV_32F, ksize=3)
+    energy = lap * lap
+    return cv2.GaussianBlur(energy, (0, 0), blur)
+
+def stack_images(paths, power=2.0):
+    # weighted blend over Z, one source image in memory at a time
+    acc = wsum = None
+    for path in paths:
+        img = read_image(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise IOError(f'unable to read {path}')
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        w = sharpness(gray.astype(np.float32))
+        if power != 1.0:
+            w = np.power(w, power, out=w)
+        w += 1e-6
+        if acc is None:
+            acc = np.zeros(img.shape, np.float32)
+            wsum = np.zeros(gray.shape, np.float32)
+        elif img.shape != acc.shape:
+            raise ValueError(f'{path} is {img.shape}, expected {acc.shape}')
+        acc += img * w[..., None]
+        wsum += w
+    acc /= wsum[..., None]
+    return np.clip(acc + 0.5, 0, 255).astype(np.uint8)
+
+def stack_job(paths, out_path, power=2.0):
+    # runs in a worker process, returns an error string or None
+    try:
+        if not cv2.imwrite(out_path, stack_images(paths, power)):
+            return 'unable to write image'
+    except Exception as ex:
+        return str(ex)
+    return None
+
+
+class IncrementalStacker(object):
+    # Stacks each XY position as soon as all its Z levels are saved. add()
+    # is called from the writer threads during a scan.
+    def __init__(self, out_dir, z_levels, workers=None, power=2.0, ext='.jpeg'):
+        self.out_dir = out_dir
+        self.z_levels = z_levels
+        self.power = power
+        self.ext = ext
+        self.lock = Lock()
+        self.pending = {}
+        self.futures = {}
+        self.stacked = 0
+        os.makedirs(out_dir, exist_ok=True)
+        self.pool = ProcessPoolExecutor(workers)
+
+    def out_path(self, name):
+        return os.path.join(self.out_dir, name + self.ext)
+
+    def add(self, key, zi, filename, name):
+        # key identifies the XY position, name is used for the output file
+        with self.lock:
+            levels = self.pending.setdefault(key, {})
+            levels[zi] = filename
+            if len(levels) < self.z_levels:
+                return
+            del self.pending[key]
+            paths = [levels[i] for i in sorted(levels)]
+            future = self.pool.submit(stack_job, paths, self.out_path(name), self.power)
+            self.futures[future] = self.out_path(name)
+            future.add_done_callback(self.on_done)
+
+    def on_done(self, future):
+        with self.lock:
+            self.stacked += 1
+
+    def close(self, wait=True):
+        # returns [(filename, error)] like ImageWriter.flush()
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        errors = []
+        for future, path in self.futures.items():
+            if future.cancelled(): continue
+            try:
+                err = future.result()
+            except Exception as ex:
+                err = str(ex)
+            if err:
+                errors.append((path, err))
+        self.futures = {}
+        return errors
+
+
+def stack_scan(scan_dir, out_dir=None, workers=None, power=2.0, progress=None):
+    # stack every XY position of a finished scan, returns [(filename, error)]
+    tiles = TileSet(scan_dir)
+    out_dir = out_dir or os.path.join(scan_dir, STACK_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    stacks = [s for s in tiles.positions().values() if len(s) > 1]
+    errors = []
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = []
+        for stack in stacks:
+            out_path = os.path.join(out_dir, stack[0].name + '.jpeg')
+            jobs.append((out_path, pool.submit(stack_job, [t.path for t in stack], out_path, power)))
+        for i, (out_path, future) in enumerate(jobs):
+            err = future.result()
+            if err:
+                errors.append((out_path, err))
+            if progress:
+                progress(i + 1, len(jobs))
+    return errors
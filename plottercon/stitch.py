@@ -0,0 +1,246 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import cv2
+import numpy as np
+from . tiles import TileSet
+from . container import read_image
+
+LAYOUT_SUFFIX = '.layout.json'
+
+
+def overlap(shape, offset, min_size=16):
+    # slices of the area shared by a tile at the origin and one at offset,
+    # in the first tile's and the second tile's pixels
+    h, w = shape[:2]
+    dx, dy = int(round(offset[0])), int(round(offset[1]))
+    x0, x1 = max(0, dx), min(w, w + dx)
+    y0, y1 = max(0, dy), min(h, h + dy)
+    if x1 - x0 < min_size or y1 - y0 < min_size:
+        return None
+    return (slice(y0, y1), slice(x0, x1)), (slice(y0 - dy, y1 - dy), slice(x0 - dx, x1 - dx))
+
+def correlate(a, b, scale):
+    # shift of b's content relative to a's, in full resolution pixels
+    if scale != 1.0:
+        a = cv2.resize(a, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        b = cv2.resize(b, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    win = cv2.createHanningWindow((a.shape[1], a.shape[0]), cv2.CV_32F)
+    (sx, sy), response = cv2.phaseCorrelate(a.astype(np.float32), b.astype(np.float32), win)
+    return (sx / scale, sy / scale), response
+
+def measure_offset(path_a, path_b, scale=0.25):
+    # worker: whole-frame offset of b from a, for the nominal step size
+    a = read_image(path_a, cv2.IMREAD_GRAYSCALE)
+    b = read_image(path_b, cv2.IMREAD_GRAYSCALE)
+    if a is None or b is None:
+        return None
+    (sx, sy), response = correlate(a, b, scale)
+    return (-sx, -sy), response
+
+def register_pair(path_a, path_b, nominal, scale=0.5):
+    # worker: refine the offset of b from a by correlating only the overlap
+    a = read_image(path_a, cv2.IMREAD_GRAYSCALE)
+    b = read_image(path_b, cv2.IMREAD_GRAYSCALE)
+    if a is None or b is None:
+        return None
+    ov = overlap(a.shape, nominal)
+    if ov is None:
+        return None
+    sa, sb = ov
+    (sx, sy), response = correlate(a[sa], b[sb], scale)
+    return (nominal[0] - sx, nominal[1] - sy), response
+
+def grid_tiles(tileset, z=None):
+    # one level of the scan as {(iy, ix): tile}
+    z = tileset.zs[0] if z is None else z
+    return {tileset.grid_index(t): t for t in tileset.level(z)}
+
+def neighbour_pairs(grid):
+    # (a, b, axis) for every tile and its +X / +Y neighbour
+    for (iy, ix), tile in grid.items():
+        for axis, key in ((0, (iy, ix + 1)), (1, (iy + 1, ix))):
+            if key in grid:
+                yield (iy, ix), key, axis
+
+def estimate_steps(pool, grid, samples=5):
+    # pixel offset for one step along X and Y, median over a few pairs
+    steps = []
+    pairs = list(neighbour_pairs(grid))
+    for axis in (0, 1):
+        axis_pairs = [p for p in pairs if p[2] == axis]
+        if not axis_pairs:
+            steps.append(None)
+            continue
+        pick = axis_pairs[::max(1, len(axis_pairs) // samples)][:samples]
+        res = pool.map(measure_offset, [grid[a].path for a, b, _ in pick], [grid[b].path for a, b, _ in pick])
+        res = [r[0] for r in res if r is not None and r[1] > 0.05]
+        steps.append(tuple(np.median(np.array(res), axis=0)) if res else None)
+    return steps
+
+def solve_positions(nominal, edges, anchor=0.01, iters=2000, tol=0.01):
+    # Jacobi relaxation of p[j] - p[i] = d over all edges, each tile also
+    # pulled weakly towards its nominal position
+    pos = nominal.copy()
+    if not edges:
+        return pos
+    i = np.array([e[0] for e in edges])
+    j = np.array([e[1] for e in edges])
+    d = np.array([e[2] for e in edges], np.float64)
+    w = np.array([e[3] for e in edges], np.float64)
+    for _ in range(iters):
+        acc = nominal * anchor
+        wsum = np.full(len(pos), anchor)
+        np.add.at(acc, j, (pos[i] + d) * w[:, None])
+        np.add.at(acc, i, (pos[j] - d) * w[:, None])
+        np.add.at(wsum, j, w)
+        np.add.at(wsum, i, w)
+        new = acc / wsum[:, None]
+        done = np.abs(new - pos).max() < tol
+        pos = new
+        if done: break
+    return pos
+
+def build_layout(scan_dir, z=None, px_per_mm=None, workers=None, min_response=0.05,
+                 max_error=0.1, progress=None):
+    # registers a scan level, returns the layout dict used by iter_strips()
+    tileset = TileSet(scan_dir)
+    grid = grid_tiles(tileset, z)
+    if not grid:
+        raise ValueError(f'no tiles in {scan_dir}')
+    keys = sorted(grid)
+    index = {k: n for n, k in enumerate(keys)}
+    first = read_image(grid[keys[0]].path, cv2.IMREAD_COLOR)
+    if first is None:
+        raise IOError(f'unable to read {grid[keys[0]].path}')
+    shape = first.shape
+    del first
+
+    with ProcessPoolExecutor(workers) as pool:
+        # nominal positions from the machine coordinates
+        step_mm = [np.diff(tileset.xs).mean() if len(tileset.xs) > 1 else 1.0,
+                   np.diff(tileset.ys).mean() if len(tileset.ys) > 1 else 1.0]
+        if px_per_mm:
+            # the camera is mounted rotated, content moves against the stage
+            per_mm = [(-px_per_mm, 0.0), (0.0, -px_per_mm)]
+        else:
+            steps = estimate_steps(pool, grid)
+            per_mm = [None, None]
+            for axis in (0, 1):
+                if steps[axis] is not None:
+                    per_mm[axis] = (steps[axis][0] / step_mm[axis], steps[axis][1] / step_mm[axis])
+            if per_mm[0] is None and per_mm[1] is None:
+                raise ValueError('unable to measure the tile overlap, give px_per_mm')
+            # a single row or column, assume square pixels for the other axis
+            if per_mm[0] is None: per_mm[0] = (-per_mm[1][1], per_mm[1][0])
+            if per_mm[1] is None: per_mm[1] = (per_mm[0][1], -per_mm[0][0])
+        ax, ay = np.array(per_mm[0]), np.array(per_mm[1])
+        nominal = np.array([grid[k].x * ax + grid[k].y * ay for k in keys])
+
+        # refine every neighbour pair on its overlap
+        pairs = list(neighbour_pairs(grid))
+        futures = []
+        for a, b, axis in pairs:
+            offset = nominal[index[b]] - nominal[index[a]]
+            futures.append(pool.submit(register_pair, grid[a].path, grid[b].path, tuple(offset)))
+        edges = []
+        limit = max_error * max(shape[:2])
+        for n, ((a, b, axis), future) in enumerate(zip(pairs, futures)):
+            res = future.result()
+            if progress:
+                progress(n + 1, len(pairs))
+            if res is None: continue
+            offset, response = res
+            expected = nominal[index[b]] - nominal[index[a]]
+            if response < min_response or np.hypot(*(np.array(offset) - expected)) > limit:
+                continue # featureless or wrong match, leave it to the neighbours
+            edges.append((index[a], index[b], offset, response))
+
+    pos = solve_positions(nominal, edges)
+    pos -= pos.min(axis=0)
+    pos = np.round(pos).astype(int)
+    width = int(pos[:, 0].max()) + shape[1]
+    height = int(pos[:, 1].max()) + shape[0]
+    return {
+        'root': os.path.abspath(scan_dir),
+        'tile_shape': list(shape),
+        'size': [width, height],
+        'px_per_mm': float(np.hypot(*ax)),
+        'pairs': len(pairs),
+        'registered': len(edges),
+        'tiles': [{'grid': list(k), 'path': os.path.relpath(grid[k].path, scan_dir),
+                   'pos': [int(p[0]), int(p[1])]} for k, p in zip(keys, pos)],
+    }
+
+def save_layout(path, layout):
+    with open(path, 'w') as f:
+        json.dump(layout, f, indent=1)
+
+def load_layout(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def feather(h, w):
+    # blend weight, highest in the tile centre and falling to 1 at the edges
+    ys = np.minimum(np.arange(h), np.arange(h)[::-1]) + 1
+    xs = np.minimum(np.arange(w), np.arange(w)[::-1]) + 1
+    return np.minimum.outer(ys, xs).astype(np.float32)
+
+def iter_strips(layout, strip=512):
+    # yields (y, rows) top to bottom. Only the tiles overlapping the current
+    # strip are decoded, so memory is one strip plus one band of tiles.
+    width, height = layout['size']
+    th, tw = layout['tile_shape'][:2]
+    weight = feather(th, tw)
+    tiles = sorted(layout['tiles'], key=lambda t: t['pos'][1])
+    nxt = 0
+    active = {}
+    for y0 in range(0, height, strip):
+        y1 = min(height, y0 + strip)
+        while nxt < len(tiles) and tiles[nxt]['pos'][1] < y1:
+            t = tiles[nxt]
+            img = read_image(os.path.join(layout['root'], t['path']), cv2.IMREAD_COLOR)
+            if img is not None:
+                active[nxt] = img
+            nxt += 1
+        acc = np.zeros((y1 - y0, width, 3), np.float32)
+        wsum = np.zeros((y1 - y0, width), np.float32)
+        for n, img in active.items():
+            x, y = tiles[n]['pos']
+            a, b = max(y0, y), min(y1, y + th)
+            if a >= b: continue
+            w = weight[a - y:b - y]
+            acc[a - y0:b - y0, x:x + tw] += img[a - y:b - y] * w[..., None]
+            wsum[a - y0:b - y0, x:x + tw] += w
+        for n in [n for n in active if tiles[n]['pos'][1] + th <= y1]:
+            del active[n]
+        np.maximum(wsum, 1e-6, out=wsum)
+        acc /= wsum[..., None]
+        yield y0, np.clip(acc + 0.5, 0, 255).astype(np.uint8)
+
+def render(layout, out_path, strip=512, progress=None):
+    # stitch into an .npy memmap, or through one into an image file
+    width, height = layout['size']
+    npy = out_path if out_path.lower().endswith('.npy') else out_path + '.tmp.npy'
+    out = np.lib.format.open_memmap(npy, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+    for y0, rows in iter_strips(layout, strip):
+        out[y0:y0 + len(rows)] = rows
+        if progress:
+            progress(y0 + len(rows), height)
+    out.flush()
+    if npy == out_path:
+        return
+    try:
+        if not cv2.imwrite(out_path, out):
+            raise IOError(f'unable to write {out_path}, try a .npy output')
+    finally:
+        del out
+        os.remove(npy)
+
+def stitch_scan(scan_dir, out_path, z=None, px_per_mm=None, workers=None, strip=512, progress=None):
+    layout = build_layout(scan_dir, z, px_per_mm, workers,
+                          progress=(lambda n, total: progress('register', n, total)) if progress else None)
+    save_layout(out_path + LAYOUT_SUFFIX, layout)
+    render(layout, out_path, strip,
+           progress=(lambda n, total: progress('render', n, total)) if progress else None)
+    return layout
@@ -0,0 +1,63 @@
+from collections import namedtuple
+import glob
+import os
+import re
+import cv2
+from . container import TileContainer, read_image
+
+NUM = r'-?[0-9.]+(?:e-?[0-9]+)?'
+# stacked tiles have no Z part
+TILE_RE = re.compile(rf'^(?:Z(?P<z>{NUM}))?Y(?P<y>{NUM})X(?P<x>{NUM})\.(?P<ext>jpe?g|png|tiff?|raw)$', re.I)
+
+# z, y, x are machine positions as floats, name is the position part of the
+# file name without Z, e.g. 'Y1.0X2.0'
+Tile = namedtuple('Tile', 'z y x name path')
+
+
+def parse_tile_name(path):
+    m = TILE_RE.match(os.path.basename(path))
+    if not m:
+        return None
+    return Tile(float(m['z'] or 0), float(m['y']), float(m['x']), f'Y{m["y"]}X{m["x"]}', path)
+
+
+class TileSet(object):
+    # The images of a finished (or running) scan, found from the Z{z}
+    # subdirectories and the Z..Y..X.. file names the scan writes, plus any
+    # tiles in a container in root (their paths don't exist on disk, read
+    # them with read()).
+    def __init__(self, root):
+        self.root = root
+        self.tiles = []
+        paths = glob.glob(os.path.join(root, 'Z*', '*')) + glob.glob(os.path.join(root, '*'))
+        if TileContainer.exists(root):
+            paths += [os.path.join(root, *name.split('/')) for name in TileContainer(root).names()]
+        for path in sorted(set(paths)):
+            tile = parse_tile_name(path)
+            if tile is not None:
+                self.tiles.append(tile)
+        self.zs = sorted(set(t.z for t in self.tiles))
+        self.ys = sorted(set(t.y for t in self.tiles))
+        self.xs = sorted(set(t.x for t in self.tiles))
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def grid_index(self, tile):
+        return self.ys.index(tile.y), self.xs.index(tile.x)
+
+    def positions(self):
+        # (y, x) -> tiles at that position ordered by Z
+        res = {}
+        for t in self.tiles:
+            res.setdefault((t.y, t.x), []).append(t)
+        for stack in res.values():
+            stack.sort(key=lambda t: t.z)
+        return res
+
+    def level(self, z):
+        return [t for t in self.tiles if t.z == z]
+
+    @staticmethod
+    def read(tile, flags=cv2.IMREAD_COLOR):
+        return read_image(tile.path, flags)
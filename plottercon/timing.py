@@ -0,0 +1,118 @@
+from collections import deque
+from threading import Lock
+import os
+import time
+
+TIMING_NAME = 'scan_timing.csv'
+
+# timestamps recorded per tile, in order
+STAMPS = ['move', 'arrive', 'settle', 'grab', 'encode', 'write']
+# phase durations, each from the previous stamp
+PHASES = ['move', 'settle', 'grab', 'encode', 'write']
+
+
+def fmt_secs(secs):
+    secs = int(secs)
+    return f'{secs // 3600}:{(secs // 60) % 60:02d}:{secs % 60:02d}'
+
+
+class ScanTimer(object):
+    # Collects per-tile timestamps, keeps rolling phase averages for the
+    # progress display and appends every tile to a CSV next to the images.
+    # With an estimate the ETA is the model's remaining time scaled by how
+    # far the measured scan has drifted from it.
+    def __init__(self, out_dir, total, window=20, estimate=None):
+        self.total = total
+        self.estimate = estimate
+        self.first = None
+        self.lock = Lock()
+        self.start = time.time()
+        self.phases = {p: deque(maxlen=window) for p in PHASES}
+        self.periods = deque(maxlen=window)
+        self.last_grab = None
+        self.done = 0
+
+        self.path = os.path.join(out_dir, TIMING_NAME)
+        new = not os.path.isfile(self.path)
+        self.f = open(self.path, 'a')
+        if new:
+            cols = ['z', 'y', 'x'] + [f't_{s}' for s in STAMPS] + [f'{p}_s' for p in PHASES]
+            self.f.write(','.join(cols) + '\n')
+            self.f.flush()
+
+    def grabbed(self, stamps):
+        # called on the scan thread, the grab-to-grab period drives the ETA
+        with self.lock:
+            if self.last_grab is not None:
+                self.periods.append(stamps['grab'] - self.last_grab)
+            self.last_grab = stamps['grab']
+
+    def tile_done(self, key, stamps):
+        # called from the writer once the file is on disk
+        durations = {}
+        prev = stamps['move']
+        for s in STAMPS[1:]:
+            durations[s if s != 'arrive' else 'move'] = stamps[s] - prev
+            prev = stamps[s]
+        with self.lock:
+            self.done += 1
+            for p in PHASES:
+                self.phases[p].append(durations[p])
+            if self.f is None: return
+            row = list(key) + [f'{stamps[s] - self.start:.4f}' for s in STAMPS]
+            row += [f'{durations[p]:.4f}' for p in PHASES]
+            self.f.write(','.join(str(v) for v in row) + '\n')
+            self.f.flush()
+
+    def averages(self):
+        with self.lock:
+            return {p: (sum(v) / len(v) if v else None) for p, v in self.phases.items()}
+
+    def period(self):
+        with self.lock:
+            return sum(self.periods) / len(self.periods) if self.periods else None
+
+    def capture_cost(self):
+        # per tile time spent outside the move and settle, None until measured
+        period = self.period()
+        avg = self.averages()
+        if period is None or avg['move'] is None or avg['settle'] is None:
+            return None
+        return max(0.0, period - avg['move'] - avg['settle'])
+
+    def model_ratio(self, index):
+        if self.first is None:
+            self.first = (index, time.time())
+            return None
+        start, t0 = self.first
+        predicted = self.estimate.at(index) - self.estimate.at(start)
+        if index - start < 3 or predicted <= 0:
+            return None
+        return (time.time() - t0) / predicted
+
+    def eta(self, index):
+        if self.estimate is not None:
+            ratio = self.model_ratio(index)
+            if ratio is not None:
+                return self.estimate.remaining(index, ratio)
+        period = self.period()
+        if period is None:
+            return None
+        return max(0, self.total - index) * period
+
+    def stats(self, index):
+        avg = self.averages()
+        res = {p: round(v, 4) for p, v in avg.items() if v is not None}
+        period = self.period()
+        if period is not None:
+            res['period'] = round(period, 4)
+        eta = self.eta(index)
+        if eta is not None:
+            res['eta'] = round(eta, 1)
+        return res
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
@@ -0,0 +1,154 @@
+from threading import Thread, Lock
+from queue import Queue, Full, Empty
+import time
+import os
+import cv2
+import numpy as np
+
+
+class ImageWriter(object):
+    def __init__(self, workers=2, max_queue=8):
+        self.queue = Queue(maxsize=max_queue)
+        self.lock = Lock()
+        self.submitted = 0
+        self.written = 0
+        self.max_depth = 0
+        self.blocked_time = 0.0
+        self.errors = []
+        self.free = [] # copy buffers returned by the workers
+        self.closed = False
+        self.threads = []
+        for i in range(workers):
+            t = Thread(target=self.worker, name=f'image writer {i}', daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def take_buffer(self, frame):
+        with self.lock:
+            for i, buf in enumerate(self.free):
+                if buf.shape == frame.shape and buf.dtype == frame.dtype:
+                    return self.free.pop(i)
+        return np.empty_like(frame)
+
+    def submit(self, filename, frame, callback=None, sink=None):
+        # copy so the camera thread can keep reusing its buffer,
+        # put() blocks when the disk falls behind.
+        # callback is run on the writer thread once the file is on disk,
+        # with the copy (only valid during the call) and the encode and
+        # write completion times. sink, e.g. a ContainerWriter, encodes
+        # and stores the image instead of a file of its own.
+        # Returns False, with an error recorded, once the writer is closed.
+        if self.closed:
+            return self.dropped(filename)
+        buf = self.take_buffer(frame)
+        np.copyto(buf, frame)
+        frame = buf
+        start = time.time()
+        while True:
+            try:
+                self.queue.put((filename, frame, callback, sink), timeout=0.1)
+                break
+            except Full:
+                if self.closed:
+                    return self.dropped(filename)
+        with self.lock:
+            self.blocked_time += time.time() - start
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def dropped(self, filename):
+        with self.lock:
+            self.errors.append((filename, 'image writer is closed'))
+        return False
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            filename, frame, callback, sink = item
+            error = None
+            timing = {}
+            try:
+                if sink is not None:
+                    buf = sink.encode(frame)
+                else:
+                    ok, buf = cv2.imencode(os.path.splitext(filename)[1], frame)
+                    if not ok: buf = None
+                timing['encode'] = time.time()
+                if buf is None:
+                    error = 'unable to encode image'
+                else:
+                    if sink is not None:
+                        sink.write(filename, buf, frame.shape)
+                    else:
+                        with open(filename, 'wb') as f:
+                            f.write(buf)
+                    timing['write'] = time.time()
+            except Exception as ex:
+                error = str(ex)
+            with self.lock:
+                if error:
+                    self.errors.append((filename, error))
+                else:
+                    self.written += 1
+            if callback and not error:
+                try:
+                    callback(frame, timing)
+                except Exception as ex:
+                    with self.lock:
+                        self.errors.append((filename, str(ex)))
+            with self.lock:
+                self.free.append(frame)
+            self.queue.task_done()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'pending': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'blocked_time': round(self.blocked_time, 3),
+                'errors': len(self.errors),
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.submitted = 0
+            self.written = 0
+            self.max_depth = 0
+            self.blocked_time = 0.0
+
+    def flush(self):
+        # wait for everything queued so far, returns and clears any errors.
+        # Doesn't wait once the writer is closed, nothing would write it.
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and not self.closed:
+                self.queue.all_tasks_done.wait(0.1)
+        with self.lock:
+            errors = list(self.errors)
+            self.errors.clear()
+        return errors
+
+    def close(self):
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        # anything submitted while closing is dropped
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self.dropped(item[0])
+            self.queue.task_done()